@@ -0,0 +1,138 @@
+"""
+Benchmarks of python-financier against an in-process fake CouchDB server
+(see pythonfinancier.fakecouch), so they need no financier.io account:
+
+    python benchmark.py --latency 0.01 --count 200
+
+For each operation it reports the throughput, the latency and the number of
+round trips to the server per call.
+"""
+
+import argparse
+import time
+import uuid
+
+from pythonfinancier import Financier
+from pythonfinancier.fakecouch import FakeCouchServer
+from pythonfinancier.ratelimit import TokenBucket
+
+BUDGET_ID = str(uuid.uuid4())
+ACCOUNTS = ['Checking', 'Savings']
+CATEGORIES = ['Rent', 'Food', 'Fun']
+PAYEES = ['Landlord', 'Grocer']
+
+
+def seed(server):
+    """
+    Create a user and a budget with a few accounts, categories and payees
+    """
+    user_db = server.add_user('bench', 'bench')
+    server.put(user_db, {'_id': 'budget_' + BUDGET_ID, 'name': 'Bench'})
+    prefix = 'b_' + BUDGET_ID
+    for kind, names in (('account', ACCOUNTS), ('category', CATEGORIES),
+                        ('payee', PAYEES)):
+        for name in names:
+            server.put(user_db, {'_id': '{0}_{1}_{2}'.format(
+                prefix, kind, uuid.uuid4()), 'name': name})
+
+
+def connect(server, preload=False):
+    f = Financier(url_couch_db=server.url, username='bench',
+                  password='bench', rate_limiter=TokenBucket(rate=None))
+    f.connect_budget('Bench', preload=preload)
+    return f
+
+
+def round_trips(f):
+    return sum(c['count'] for c in f.stats()['requests'].values())
+
+
+def measure(name, f, call, count):
+    """
+    Run ``call(i)`` ``count`` times and print its throughput, mean latency
+    and round trips per call
+    """
+    before = round_trips(f)
+    start = time.perf_counter()
+    for i in range(count):
+        call(i)
+    elapsed = time.perf_counter() - start
+    print('{0:<28} {1:>9.1f} ops/s {2:>9.2f} ms/op {3:>6.2f} trips/op'.format(
+        name, count / elapsed, 1000 * elapsed / count,
+        (round_trips(f) - before) / count))
+
+
+def bench_saves(server, count):
+    f = connect(server)
+
+    def transaction(i):
+        f.save_transaction(ACCOUNTS[0], CATEGORIES[i % 3], -100 - i,
+                           '2024-01-01', PAYEES[i % 2], 'bench')
+
+    def split(i):
+        f.save_split(ACCOUNTS[0], -300, '2024-01-02', PAYEES[0], 'bench',
+                     [{'category_name': CATEGORIES[0], 'value': -100,
+                       'payee_name': PAYEES[0], 'memo': ''},
+                      {'category_name': CATEGORIES[1], 'value': -200,
+                       'payee_name': PAYEES[1], 'memo': ''}])
+
+    def transfer(i):
+        f.save_transfer(ACCOUNTS[0], ACCOUNTS[1], 1000 + i, '2024-01-03',
+                        'bench')
+
+    measure('save_transaction', f, transaction, count)
+    measure('save_split', f, split, count)
+    measure('save_transfer', f, transfer, count)
+    rows = [{'account_name': ACCOUNTS[0], 'category_name': CATEGORIES[1],
+             'value': -i, 'date': '2024-01-04', 'payee_name': PAYEES[1],
+             'memo': 'bench'} for i in range(count)]
+    before = round_trips(f)
+    start = time.perf_counter()
+    f.save_transactions(rows)
+    elapsed = time.perf_counter() - start
+    print('{0:<28} {1:>9.1f} ops/s {2:>9.2f} ms/op {3:>6.2f} trips/op'.format(
+        'save_transactions', count / elapsed, 1000 * elapsed / count,
+        (round_trips(f) - before) / count))
+
+
+def bench_lookups(server, count):
+    def lookups(f):
+        f.find_account(ACCOUNTS[0])
+        f.find_category(CATEGORIES[0])
+        f.get_or_create_payee(PAYEES[0])
+
+    # every call starts with empty maps
+    f = connect(server)
+
+    def cold(i):
+        for name_map in f._maps().values():
+            name_map.clear()
+        lookups(f)
+
+    measure('lookups (cold maps)', f, cold, count)
+    measure('lookups (warm maps)', f, lambda i: lookups(f), count)
+    f = connect(server, preload=True)
+    measure('lookups (preloaded maps)', f, lambda i: lookups(f), count)
+    start = time.perf_counter()
+    connect(server, preload=True)
+    print('{0:<28} {1:>25.2f} ms'.format(
+        'connect_budget(preload)', 1000 * (time.perf_counter() - start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='delay added to every request, in seconds')
+    parser.add_argument('--count', type=int, default=100,
+                        help='number of calls of each operation')
+    args = parser.parse_args()
+    with FakeCouchServer(latency=args.latency) as server:
+        seed(server)
+        print('latency {0} ms, {1} calls per operation'.format(
+            1000 * args.latency, args.count))
+        bench_saves(server, args.count)
+        bench_lookups(server, args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+In-process account balances and category activity of a budget, kept up to
+date from the CouchDB changes feed. The totals are built once with a full
+scan of the transactions; afterwards, each refresh only reads the
+transactions changed since the last one. The contribution of every
+transaction to the totals is remembered, so an edited or deleted
+transaction is first taken back out of the totals, without fetching its
+previous revision.
+"""
+
+import logging
+import threading
+
+
+def contribution(doc):
+    """
+    Compute what a transaction adds to the totals
+
+    Parameters
+    ----------
+    doc : dict
+        Transaction document
+
+    Returns
+    -------
+        Tuple ``(account, value, activity)``: the account id and value
+        added to its balance, and a tuple of ``(category, month, value)``
+        (one per split for split transactions)
+    """
+    value = doc.get('value') or 0
+    month = (doc.get('date') or '')[:7]
+    splits = doc.get('splits')
+    if splits:
+        activity = tuple((s['category'], month, s.get('value') or 0)
+                         for s in splits if s.get('category'))
+    elif doc.get('category'):
+        activity = ((doc['category'], month, value),)
+    else:
+        activity = ()
+    return doc.get('account'), value, activity
+
+
+class AggregateStore:
+    """
+    Balance of each account and activity of each category per month, for
+    the active budget of a Financier instance
+    """
+
+    def __init__(self, financier, page_size=1000):
+        """
+        Create an AggregateStore; nothing is loaded until :meth:`refresh`
+
+        Parameters
+        ----------
+        financier : Financier
+            Instance connected to the budget
+        page_size : int
+            Number of transactions (or changes) read per request
+        """
+        self.logger = logging.getLogger(__name__)
+        self.financier = financier
+        self.page_size = page_size
+        self.prefix = '{0}_transaction_'.format(financier.budget_selector)
+        self.lock = threading.RLock()
+        # account id -> balance
+        self.balances = {}
+        # month -> category id -> activity
+        self.activity = {}
+        # transaction id -> its contribution currently in the totals
+        self.contributions = {}
+        # sequence of the changes feed the totals are up to date with
+        self.seq = None
+
+    def _add(self, doc_id, doc):
+        old = self.contributions.pop(doc_id, None)
+        if old is not None:
+            account, value, activity = old
+            self._apply(account, -value,
+                        [(c, m, -v) for c, m, v in activity])
+        if doc is not None and not doc.get('_deleted'):
+            new = contribution(doc)
+            self.contributions[doc_id] = new
+            self._apply(*new)
+
+    def _apply(self, account, value, activity):
+        if account is not None:
+            self.balances[account] = self.balances.get(account, 0) + value
+        for category, month, amount in activity:
+            month_activity = self.activity.setdefault(month, {})
+            total = month_activity.get(category, 0) + amount
+            if total:
+                month_activity[category] = total
+            else:
+                # e.g. the only transaction of the category was deleted
+                month_activity.pop(category, None)
+                if not month_activity:
+                    del self.activity[month]
+
+    def rebuild(self):
+        """
+        Compute the totals from scratch, with a full scan of the
+        transactions of the budget
+        """
+        cdb = self.financier.cdb
+        user_db = self.financier.user_db
+        seq = cdb.db_info(user_db).json()['update_seq']
+        with self.lock:
+            self.balances.clear()
+            self.activity.clear()
+            self.contributions.clear()
+            params = {'startkey': self.prefix}
+            while True:
+                rows = cdb.all_docs(user_db, endkey=self.prefix + '\ufff0',
+                                    include_docs=True, limit=self.page_size,
+                                    **params).json()['rows']
+                for row in rows:
+                    if row.get('doc'):
+                        self._add(row['id'], row['doc'])
+                if len(rows) < self.page_size:
+                    break
+                params = {'startkey': rows[-1]['id'], 'skip': 1}
+            # changes made during the scan are applied again by the next
+            # refresh, which is harmless
+            self.seq = seq
+        self.logger.info('aggregated {0} transactions'.format(
+            len(self.contributions)))
+
+    def refresh(self):
+        """
+        Bring the totals up to date: apply the transactions created,
+        edited or deleted since the last refresh (building the totals with
+        :meth:`rebuild` the first time)
+
+        Returns
+        -------
+            Number of transactions of the budget that changed
+        """
+        if self.seq is None:
+            self.rebuild()
+            return len(self.contributions)
+        cdb = self.financier.cdb
+        user_db = self.financier.user_db
+        changed = 0
+        with self.lock:
+            while True:
+                res = cdb.changes(user_db, since=self.seq,
+                                  limit=self.page_size).json()
+                ids = list({row['id'] for row in res['results']
+                            if row['id'].startswith(self.prefix)})
+                if ids:
+                    # fetch only the changed transactions, not every
+                    # changed doc
+                    rows = cdb.all_docs(user_db, keys=ids,
+                                        include_docs=True).json()['rows']
+                    for row in rows:
+                        self._add(row['key'], row.get('doc'))
+                changed += len(ids)
+                self.seq = res['last_seq']
+                if len(res['results']) < self.page_size:
+                    break
+        self.logger.debug('applied {0} changed transactions'.format(
+            changed))
+        return changed
+
+    def balance(self, account_name):
+        """
+        Get the balance of an account
+
+        Parameters
+        ----------
+        account_name : str
+
+        Returns
+        -------
+            Balance in cents
+        """
+        account_id = self.financier.find_account(account_name)['_id']
+        return self.balances.get(account_id, 0)
+
+    def category_activity(self, category_name, month):
+        """
+        Get the total of the transactions of a category in a month
+
+        Parameters
+        ----------
+        category_name : str
+        month : str
+            YYYY-MM
+
+        Returns
+        -------
+            Activity in cents
+        """
+        category_id = self.financier.find_category(category_name)['_id']
+        return self.activity.get(month, {}).get(category_id, 0)
+
+    def month_activity(self, month):
+        """
+        Get the activity of every category in a month
+
+        Parameters
+        ----------
+        month : str
+            YYYY-MM
+
+        Returns
+        -------
+            Dictionary of the activity (in cents) by category id (or
+            special category, e.g. 'income')
+        """
+        with self.lock:
+            return dict(self.activity.get(month, {}))
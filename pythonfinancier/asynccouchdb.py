@@ -0,0 +1,270 @@
+"""
+An asyncio twin of :mod:`pythonfinancier.easycouchdb`, built on a pooled
+``aiohttp`` client, so many requests can be in flight at once. Requires the
+optional ``aiohttp`` package.
+"""
+
+import asyncio
+import json
+import logging
+from urllib.parse import urljoin
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from pythonfinancier.ratelimit import retry_after_seconds
+
+
+class CouchResponse:
+    """
+    Fully read response of an AsyncEasyCouchdb request, with the parts of
+    the :class:`requests.Response` interface used by python-financier
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError('HTTP error {0}: {1}'.format(
+                self.status_code, self.content[:200]))
+
+    def __repr__(self):
+        return '<CouchResponse [{0}]>'.format(self.status_code)
+
+
+class AsyncEasyCouchdb:
+    """
+    Easily get, insert, and update documents within a CouchDB database,
+    from asyncio code.
+    """
+
+    SESSION = '_session'
+    ALL_DBS = '_all_dbs'
+    ALL_DOCS = '_all_docs'
+    FIND = '_find'
+    BULK_DOCS = '_bulk_docs'
+    CHANGES = '_changes'
+    TIMEOUT = 10
+    # number of times a request is repeated when the server answers 429/503
+    BACKOFF_RETRIES = 3
+    BACKOFF_STATUS = (429, 503)
+
+    req_session = None
+
+    def __init__(self, url, concurrency=10):
+        """
+        Create an AsyncEasyCouchdb instance
+
+        Parameters
+        ----------
+        url : str
+        concurrency : int
+            Maximum number of requests in flight at the same time (this is
+            also the size of the connection pool)
+        """
+        if aiohttp is None:
+            raise ImportError('AsyncEasyCouchdb requires the aiohttp package')
+        self.logger = logging.getLogger(__name__)
+        self.url = url
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.SESSION_URL = urljoin(self.url, self.SESSION)
+        self.ALL_DBS_URL = urljoin(self.url, self.ALL_DBS)
+        self.logger.debug('SESSION_URL: {}'.format(self.SESSION_URL))
+
+    async def login(self, username, password):
+        """
+        Login to the database
+
+        Parameters
+        ----------
+        username : str
+        password : str
+
+        Returns
+        -------
+            Response to the login POST request
+        """
+        if self.req_session is None:
+            self.req_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                # also keep the AuthSession cookie of servers reached by
+                # IP address
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=self.TIMEOUT))
+        return await self._request('post', self.SESSION_URL,
+                                   data={'name': username,
+                                         'password': password})
+
+    async def close(self):
+        """
+        Close the connection pool
+        """
+        if self.req_session is not None:
+            await self.req_session.close()
+            self.req_session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _request(self, method, url, **kwargs):
+        """
+        Send a request once a concurrency slot is free, repeating it (a few
+        times) if the server answers that it is overloaded
+
+        Parameters
+        ----------
+        method : str
+            HTTP method ('get', 'post', ...)
+        url : str
+            Full url of the request
+        kwargs
+            Passed on to :meth:`aiohttp.ClientSession.request`
+
+        Returns
+        -------
+            CouchResponse of the request
+        """
+        for attempt in range(self.BACKOFF_RETRIES + 1):
+            async with self.semaphore:
+                async with self.req_session.request(method, url,
+                                                    **kwargs) as res:
+                    response = CouchResponse(res.status, res.headers,
+                                             await res.read())
+            if response.status_code not in self.BACKOFF_STATUS:
+                break
+            wait = retry_after_seconds(
+                response.headers.get('Retry-After')) or 2 ** attempt
+            self.logger.info('{0} {1} answered {2}, waiting {3}s'.format(
+                method.upper(), url, response.status_code, wait))
+            await asyncio.sleep(wait)
+        return response
+
+    async def all_docs(self, db_name, keys=None, **params):
+        """
+        Get all documents from the CouchDB instance
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database to query
+        keys : None or list
+            If given, only the rows for these document ids are returned
+        params
+            Other query parameters of ``_all_docs``; values are JSON-encoded
+
+        Returns
+        -------
+            Response to the all_docs request
+        """
+        url = urljoin(self.url, '/'.join([db_name, self.ALL_DOCS]))
+        params = {k: json.dumps(v) for k, v in params.items()}
+        if keys is not None:
+            return await self._request('post', url, params=params,
+                                       json={'keys': keys})
+        return await self._request('get', url, params=params)
+
+    async def query(self, db_name, selector):
+        """
+        Query the database with a given selector
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database to query
+        selector : dict
+            Selector to use for the query
+
+        Returns
+        -------
+            Response of the ``_find`` request
+        """
+        self.logger.debug('executing query: {0}'.format(selector))
+        return await self._request(
+            'post', urljoin(self.url, '/'.join([db_name, self.FIND])),
+            json=selector)
+
+    async def insert(self, db_name, doc):
+        """
+        Insert a document into the database
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database into which to insert
+        doc : dict
+            JSON-formatted dictionary of the document to add
+
+        Returns
+        -------
+            Response of the POST request for the insertion
+        """
+        return await self._request('post', urljoin(self.url, db_name),
+                                   json=doc)
+
+    async def save(self, db_name, doc):
+        """
+        Update a document with a given id in the database
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database into which to insert
+        doc : dict
+            JSON-formatted dictionary of the document to add
+
+        Returns
+        -------
+            Response of the PUT request for the document update
+        """
+        return await self._request(
+            'put', urljoin(self.url, '/'.join([db_name, doc['_id']])),
+            json=doc)
+
+    async def get_doc(self, db_name, _id):
+        """
+        Get a document from the database with a given id value
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database from which to get the document
+        _id : str
+            ID value of the document
+
+        Returns
+        -------
+            Response of the GET request for the document retrieval
+        """
+        return await self._request(
+            'get', urljoin(self.url, '/'.join([db_name, _id])))
+
+    async def bulk_docs(self, db_name, docs):
+        """
+        Insert or update several documents with a single request
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database into which to write
+        docs : list
+            List of JSON-formatted dictionaries of the documents to write
+
+        Returns
+        -------
+            Response of the POST request (one result per document)
+        """
+        return await self._request(
+            'post', urljoin(self.url, '/'.join([db_name, self.BULK_DOCS])),
+            json={'docs': docs})
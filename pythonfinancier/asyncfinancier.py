@@ -0,0 +1,458 @@
+"""
+An asyncio twin of :mod:`pythonfinancier.financier`: transactions of one or
+several budgets can be saved concurrently, e.g. with ``asyncio.gather``.
+Requires the optional ``aiohttp`` package.
+"""
+
+import asyncio
+import configparser
+import logging
+import uuid
+
+from pythonfinancier.asynccouchdb import AsyncEasyCouchdb
+from pythonfinancier.financier import Financier, id_range, split_id
+
+
+class AsyncFinancier:
+    """
+    A class to interact with a Financier user's database from asyncio code.
+    Use it as an async context manager (or call :meth:`login` and
+    :meth:`close` yourself)::
+
+        async with AsyncFinancier(url, username, password) as f:
+            await f.connect_budget('Personal')
+            await asyncio.gather(*[f.save_transaction(...) for ...])
+    """
+
+    def __init__(self,
+                 url_couch_db=None,
+                 username=None,
+                 password=None,
+                 conf_file='python-financier.ini',
+                 concurrency=10):
+        """
+        Create a new instance of the AsyncFinancier class (nothing is sent
+        to the database until :meth:`login`)
+
+        Parameters
+        ----------
+        url_couch_db : None or str
+            If None, value is read from config file ``conf_file``
+            If string, Web url of the Financier database to which to connect
+        username : None or str
+            If None, value is read from config file ``conf_file``
+            If string, username to login with
+        password : None or str
+            If None, value is read from config file ``conf_file``
+            If string, password to login with
+        conf_file : str
+            Location of configuration file from which to read settings
+        concurrency : int
+            Maximum number of requests in flight at the same time
+        """
+        if None in (url_couch_db, username, password):
+            config = configparser.ConfigParser()
+            config.read(conf_file)
+            url_couch_db = url_couch_db or config['Financier']['url_couch_db']
+            username = username or config['Financier']['username']
+            password = password or config['Financier']['password']
+
+        self.logger = logging.getLogger(__name__)
+        self.cdb = AsyncEasyCouchdb(url_couch_db, concurrency=concurrency)
+        self.username = username
+        self.password = password
+        self.user_db = None
+        self.account_map = {}
+        self.category_map = {}
+        self.payee_map = {}
+        self.budget_selector = ''
+        # lookups currently in flight, so that concurrent calls for the same
+        # name share one request (and create one payee)
+        self._pending = {}
+
+    # these only depend on the active budget, not on how requests are sent
+    transaction_uuid = Financier.transaction_uuid
+    get_id_transaction = Financier.get_id_transaction
+    _map_entry = staticmethod(Financier._map_entry)
+
+    async def login(self):
+        """
+        Login to the database and find the user database
+        """
+        login_json = (await self.cdb.login(self.username,
+                                           self.password)).json()
+        if 'error' in login_json:
+            raise ConnectionError('Could not connect: ' + login_json[
+                'reason'])
+        self.user_db = next(r for r in login_json['roles']
+                            if r.startswith('userdb'))
+        self.logger.debug('Connecting on db {0}'.format(self.user_db))
+
+    async def close(self):
+        """
+        Close the connection pool
+        """
+        await self.cdb.close()
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _single_flight(self, name_map, kind, name, lookup):
+        """
+        Get ``name`` from ``name_map``, or run ``lookup(name)`` to get it,
+        making sure only one lookup per name is in flight at any time
+        """
+        if name in name_map:
+            return name_map[name]
+        key = (kind, name)
+        if key not in self._pending:
+            self._pending[key] = asyncio.ensure_future(lookup(name))
+        try:
+            res = await asyncio.shield(self._pending[key])
+        finally:
+            self._pending.pop(key, None)
+        name_map[name] = res
+        return res
+
+    async def find_budget(self, name):
+        """
+        Find budget(s) by name within the database
+
+        Parameters
+        ----------
+        name : str
+            Name for which to search (must be an exact match)
+        Returns
+        -------
+            List of budget json objects that match the given name
+        """
+        res = await self.cdb.query(self.user_db, {
+            'selector': {'_id': id_range('budget_'), 'name': name},
+            'fields': ['_id', 'name']})
+        return res.json()['docs']
+
+    async def connect_budget(self, name, preload=False):
+        """
+        Set a particular budget as "active"
+
+        Parameters
+        ----------
+        name : str
+            Name of the budget to use (must be an exact match)
+        preload : bool
+            If True, load every account, category and payee of the budget
+            into the local maps right away
+        """
+        budget = await self.find_budget(name)
+        if not budget:
+            raise Exception('Budget not found')
+        self.budget_selector = budget[0]['_id'].replace('budget', 'b')
+        self.account_map.clear()
+        self.category_map.clear()
+        self.payee_map.clear()
+        if preload:
+            await self.refresh_maps()
+
+    async def refresh_maps(self):
+        """
+        (Re)load the account, category and payee maps of the active budget,
+        with concurrent ``_all_docs`` range scans
+        """
+        maps = {'account': self.account_map,
+                'category': self.category_map,
+                'payee': self.payee_map}
+        results = await asyncio.gather(*[self.prefix_docs(kind)
+                                         for kind in maps])
+        for (kind, name_map), docs in zip(maps.items(), results):
+            name_map.clear()
+            for doc in docs:
+                if doc.get('name') is None or doc['name'] in name_map:
+                    continue
+                name_map[doc['name']] = self._map_entry(kind, doc)
+
+    async def prefix_docs(self, kind):
+        """
+        Get all the documents of one type in the active budget
+
+        Parameters
+        ----------
+        kind : str
+            Type of the documents (e.g. 'account', 'category', 'payee')
+
+        Returns
+        -------
+            List of the documents
+        """
+        prefix = '{0}_{1}_'.format(self.budget_selector, kind)
+        res = await self.cdb.all_docs(self.user_db,
+                                      startkey=prefix,
+                                      endkey=prefix + '\ufff0',
+                                      include_docs=True)
+        return [r['doc'] for r in res.json()['rows'] if r.get('doc')]
+
+    async def _find_named(self, kind, name):
+        selector = {
+            '_id': id_range('{0}_{1}_'.format(self.budget_selector, kind)),
+            'name': name}
+        fields = ['_id', 'name']
+        if kind == 'payee':
+            fields.append('categorySuggest')
+        res = await self.cdb.query(self.user_db, {'selector': selector,
+                                                  'fields': fields})
+        return res.json()['docs']
+
+    async def find_account(self, name):
+        """
+        Find an account by name, checking the local account map first.
+        Raises a ValueError if the account is not found.
+
+        Parameters
+        ----------
+        name : str
+            Name for which to search (must be an exact match)
+        Returns
+        -------
+            The doc dictionary of the account (with bare ``_id``)
+        """
+        async def lookup(name):
+            res = await self._find_named('account', name)
+            if not res:
+                raise ValueError("Account not found")
+            return {'_id': split_id(res[0]['_id']), 'name': res[0]['name']}
+
+        return await self._single_flight(self.account_map, 'account', name,
+                                         lookup)
+
+    async def find_category(self, name):
+        """
+        Find a category by name, checking the local category map first.
+        Raises a ValueError if the category is not found.
+
+        Parameters
+        ----------
+        name : str
+            Name for which to search (must be an exact match)
+        Returns
+        -------
+            Doc dictionary of the category with bare ``_id`` and ``name``
+        """
+        if name in ['income', 'incomeNextMonth']:
+            return {'_id': name, 'name': name}
+
+        async def lookup(name):
+            res = await self._find_named('category', name)
+            if not res:
+                raise ValueError("Category not found")
+            return {'_id': split_id(res[0]['_id']), 'name': res[0]['name']}
+
+        return await self._single_flight(self.category_map, 'category',
+                                         name, lookup)
+
+    async def find_payee(self, name):
+        """
+        Find payee(s) by name within the database
+
+        Parameters
+        ----------
+        name : str
+            Name for which to search (must be an exact match)
+        Returns
+        -------
+            List of payee json objects that match the given name
+        """
+        return await self._find_named('payee', name)
+
+    async def insert_payee(self, name):
+        """
+        Insert a payee into the database with the given name
+
+        Parameters
+        ----------
+        name : str
+
+        Returns
+        -------
+            JSON response of the insert request
+        """
+        doc = {
+            '_id': '{0}_payee_{1}'.format(self.budget_selector, uuid.uuid4()),
+            'name': name, 'internal': False, 'autosuggest': True}
+        return (await self.cdb.insert(self.user_db, doc)).json()
+
+    async def get_or_create_payee(self, name):
+        """
+        Return a payee, and create it if it does not exist. Concurrent calls
+        for the same new name create a single payee.
+
+        Parameters
+        ----------
+        name : str
+            Name of the payee to use or get
+
+        Returns
+        -------
+            The doc dictionary of the existing (or created) payee
+        """
+        async def lookup(name):
+            payee = await self.find_payee(name)
+            if payee:
+                payee = payee[0]
+                payee['_id'] = split_id(payee['_id'])
+                return payee
+            payee = await self.insert_payee(name)
+            payee['_id'] = split_id(payee['id'])
+            self.logger.info('added payee ({}) to remote database'.format(
+                name))
+            return payee
+
+        return await self._single_flight(self.payee_map, 'payee', name,
+                                         lookup)
+
+    async def get_transaction(self, id_transaction):
+        """
+        Get the JSON object representing a transaction
+
+        Parameters
+        ----------
+        id_transaction : str
+            transaction id of the form
+            "<BUDGET UUID4>_transaction_<TRANSACTION UUID4>"
+
+        Returns
+        -------
+            JSON representation of the transaction object in the database
+        """
+        return (await self.cdb.get_doc(self.user_db, id_transaction)).json()
+
+    async def _save_new(self, doc):
+        res = await self.cdb.save(self.user_db, doc)
+        if res.status_code == 409:
+            self.logger.warning(
+                'transaction {0} has already been imported '.format(
+                    doc['_id']))
+            return None
+        return res
+
+    def _new_uuid(self, idempotent, external_id, *key):
+        if idempotent or external_id is not None:
+            return self.transaction_uuid(*key, external_id=external_id)
+        return self.transaction_uuid()
+
+    async def save_transaction(self, account_name,
+                               category_name, value, date,
+                               payee_name, memo,
+                               idempotent=False, external_id=None):
+        """
+        Add a transaction to the database of the active budget (see
+        :meth:`Financier.save_transaction`)
+
+        Returns
+        -------
+            Response of the database upon inserting the transaction, or None
+            if the transaction had already been imported
+        """
+        account, payee, category = await asyncio.gather(
+            self.find_account(account_name),
+            self.get_or_create_payee(payee_name),
+            self.find_category(category_name))
+        this_id = self._new_uuid(idempotent, external_id, account['_id'],
+                                 date, value, payee_name, memo)
+        doc = {'_id': self.get_id_transaction(this_id), 'value': value,
+               'account': account['_id'],
+               'payee': payee['_id'], 'date': date,
+               'category': category['_id'], 'memo': memo}
+        return await self._save_new(doc)
+
+    async def save_split(self, account_name,
+                         value, date, payee_name,
+                         memo, transactions,
+                         idempotent=False, external_id=None):
+        """
+        Add a split transaction to the database (see
+        :meth:`Financier.save_split`)
+
+        Returns
+        -------
+            Response of the database upon inserting the transaction, or None
+            if the transaction had already been imported
+        """
+        account, payee = await asyncio.gather(
+            self.find_account(account_name),
+            self.get_or_create_payee(payee_name))
+        this_id = self._new_uuid(idempotent, external_id, account['_id'],
+                                 date, value, payee_name, memo)
+
+        async def resolve(t):
+            category, split_payee = await asyncio.gather(
+                self.find_category(t.pop('category_name')),
+                self.get_or_create_payee(t.pop('payee_name')))
+            t['category'] = category['_id']
+            t['payee'] = split_payee['_id']
+            return t
+
+        transactions[:] = await asyncio.gather(*[resolve(t)
+                                                 for t in transactions])
+        doc = {'_id': self.get_id_transaction(this_id), 'value': value,
+               'account': account['_id'],
+               'payee': payee['_id'], 'date': date,
+               'category': 'split', 'memo': memo,
+               'splits': transactions}
+        return await self._save_new(doc)
+
+    async def save_transfer(self,
+                            from_account_name,
+                            to_account_name,
+                            value,
+                            date,
+                            memo=None,
+                            from_category_name=None,
+                            idempotent=False,
+                            external_id=None):
+        """
+        Add a transfer between two accounts to the database (see
+        :meth:`Financier.save_transfer`)
+
+        Returns
+        -------
+            Responses of the database upon inserting both transactions
+        """
+        from_account, to_account = await asyncio.gather(
+            self.find_account(from_account_name),
+            self.find_account(to_account_name))
+        if from_category_name:
+            from_category_id = (await self.find_category(
+                from_category_name))['_id']
+        else:
+            from_category_id = None
+
+        if external_id is not None:
+            from_id = self.transaction_uuid(
+                external_id=str(external_id) + '|from')
+            to_id = self.transaction_uuid(external_id=str(external_id) + '|to')
+        elif idempotent:
+            key = (from_account['_id'], to_account['_id'], date, value, memo)
+            from_id = self.transaction_uuid(*key, 'from')
+            to_id = self.transaction_uuid(*key, 'to')
+        else:
+            from_id = self.transaction_uuid()
+            to_id = self.transaction_uuid()
+
+        from_doc = {'_id': self.get_id_transaction(from_id),
+                    'value': -1 * value,
+                    'account': from_account['_id'],
+                    'date': date,
+                    'memo': memo,
+                    'category': from_category_id,
+                    'transfer': to_id}
+        to_doc = {'_id': self.get_id_transaction(to_id),
+                  'value': value,
+                  'account': to_account['_id'],
+                  'date': date,
+                  'memo': memo,
+                  'transfer': from_id}
+        return tuple(await asyncio.gather(self._save_new(from_doc),
+                                          self._save_new(to_doc)))
@@ -0,0 +1,188 @@
+"""
+Caches of the account, category and payee maps of a budget: a bounded
+in-memory mapping (LRU with an optional time to live), and a small on-disk
+cache so the maps survive restarts. Along with the maps, the on-disk cache
+stores the CouchDB sequence they are up to date with, so only the changes
+made since then need to be applied when it is loaded again.
+"""
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import json
+import logging
+import os
+import threading
+import time
+
+
+class LRUCache(MutableMapping):
+    """
+    Thread-safe mapping keeping at most ``maxsize`` entries (evicting the
+    least recently used ones), each for at most ``ttl`` seconds. With the
+    defaults it behaves like a plain dict.
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        """
+        Create an LRUCache
+
+        Parameters
+        ----------
+        maxsize : None or int
+            Maximum number of entries (unbounded if None)
+        ttl : None or float
+            Number of seconds after which an entry expires (never if None)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        # key -> (value, expiry time or None), least recently used first
+        self.data = OrderedDict()
+
+    def _expired(self, entry):
+        return entry[1] is not None and entry[1] <= time.monotonic()
+
+    def __getitem__(self, key):
+        with self.lock:
+            entry = self.data[key]
+            if self._expired(entry):
+                del self.data[key]
+                raise KeyError(key)
+            self.data.move_to_end(key)
+            return entry[0]
+
+    def __setitem__(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self.data) > self.maxsize:
+                    self.data.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            return entry is not None and not self._expired(entry)
+
+    def _live(self):
+        with self.lock:
+            if self.ttl is not None:
+                for key in [k for k, e in self.data.items()
+                            if self._expired(e)]:
+                    del self.data[key]
+            return [(k, e[0]) for k, e in self.data.items()]
+
+    def __iter__(self):
+        return iter([k for k, v in self._live()])
+
+    def __len__(self):
+        return len(self._live())
+
+    def items(self):
+        """
+        List of the ``(key, value)`` pairs that have not expired (without
+        marking them as recently used)
+        """
+        return self._live()
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __repr__(self):
+        return 'LRUCache({0!r})'.format(dict(self._live()))
+
+
+class MetadataCache:
+    """
+    JSON file holding the lookup maps of one budget and the ``update_seq``
+    they correspond to
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        """
+        Create a MetadataCache
+
+        Parameters
+        ----------
+        path : str
+            Location of the cache file
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+
+    @classmethod
+    def for_budget(cls, cache_dir, user_db, budget_selector):
+        """
+        Get the cache of a given budget within a directory
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory in which cache files are kept
+        user_db : str
+            Name of the user database
+        budget_selector : str
+            Id prefix of the budget ("b_<BUDGET UUID4>")
+
+        Returns
+        -------
+            MetadataCache instance
+        """
+        return cls(os.path.join(cache_dir, '{0}_{1}.json'.format(
+            user_db, budget_selector)))
+
+    def load(self):
+        """
+        Read the cache file
+
+        Returns
+        -------
+            Tuple ``(update_seq, maps)``, where ``maps`` is a dict of the
+            ``'account'``, ``'category'`` and ``'payee'`` maps, or None if
+            there is no usable cache file
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.warning('ignoring unreadable cache {0}: {1}'.format(
+                self.path, e))
+            return None
+        if data.get('version') != self.VERSION:
+            return None
+        return data['update_seq'], data['maps']
+
+    def save(self, update_seq, maps):
+        """
+        Write the cache file (atomically, so a crash never leaves a
+        truncated file behind)
+
+        Parameters
+        ----------
+        update_seq : str or int
+            Database sequence the maps are up to date with
+        maps : dict
+            The ``'account'``, ``'category'`` and ``'payee'`` maps
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.VERSION,
+                       'update_seq': update_seq,
+                       'maps': {k: dict(v.items())
+                                for k, v in maps.items()}}, f)
+        os.replace(tmp_path, self.path)
+        self.logger.debug('saved cache {0} at seq {1}'.format(
+            self.path, update_seq))
@@ -4,10 +4,17 @@ login, querying, listing all documents, and inserting/saving values
 """
 
 import requests
+import gzip
+import json
 from urllib.parse import urljoin
-from time import sleep
 from requests.adapters import HTTPAdapter
 import logging
+import os
+import threading
+import time
+
+from pythonfinancier.metrics import Metrics
+from pythonfinancier.ratelimit import AimdRateLimiter, retry_after_seconds
 
 
 class EasyCouchdb:
@@ -19,24 +26,134 @@ class EasyCouchdb:
     ALL_DBS = '_all_dbs'
     ALL_DOCS = '_all_docs'
     FIND = '_find'
+    BULK_DOCS = '_bulk_docs'
+    BULK_GET = '_bulk_get'
+    CHANGES = '_changes'
+    INDEX = '_index'
     TIMEOUT = 10
+    # number of times a request is repeated when the server answers
+    # 429/503 (after the rate limiter has backed off)
+    BACKOFF_RETRIES = 3
+
+    SESSION_COOKIE = 'AuthSession'
+    # lifetime assumed for a session cookie sent without an expiry date
+    # (CouchDB's default session timeout)
+    SESSION_MAX_AGE = 600
+    # timeout (in seconds) of each operation, when longer than TIMEOUT
+    TIMEOUTS = {'query': 30, 'all_docs': 60, 'bulk_docs': 120,
+                'bulk_get': 60, 'changes': 60, 'view': 120}
+    # request bodies smaller than this are not worth compressing
+    COMPRESS_MIN_SIZE = 1024
 
     req_session = None
 
-    def __init__(self, url):
+    def __init__(self, url, rate_limiter=None, session_file=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 max_retries=5, keep_alive=True, timeouts=None,
+                 compress_requests=False, adapter=None, metrics=None):
         """
         Create an EasyCouchdb instance
 
         Parameters
         ----------
         url : str
+        rate_limiter : None or TokenBucket
+            Limiter pacing the requests (see
+            :mod:`pythonfinancier.ratelimit`); it can be shared between
+            threads and instances. If None, an
+            :class:`~pythonfinancier.ratelimit.AimdRateLimiter` starting at
+            2 requests/s is used. Use ``TokenBucket(rate=None)`` to disable
+            rate limiting.
+        session_file : None or str
+            If given, the ``AuthSession`` cookie is saved to this (private)
+            file after logging in, and reused by later instances until it
+            expires, without logging in again
+        pool_connections : int
+            Number of hosts for which a connection pool is kept
+        pool_maxsize : int
+            Maximum number of connections kept open per host; use about as
+            many as the number of threads sharing this instance
+        pool_block : bool
+            If True, never open more than ``pool_maxsize`` connections to a
+            host (requests wait for a free connection instead)
+        max_retries : int
+            Number of times a failed connection is retried
+        keep_alive : bool
+            Whether connections are kept open between requests
+        timeouts : None or dict
+            Timeout in seconds of some operations (e.g.
+            ``{'bulk_docs': 300}``), overriding ``TIMEOUTS``; other
+            operations use ``TIMEOUT``
+        compress_requests : bool
+            Whether to gzip JSON request bodies (of at least
+            ``COMPRESS_MIN_SIZE`` bytes). Responses are always requested
+            compressed.
+        adapter : None or HTTPAdapter
+            Adapter (holding the connection pools) to use instead of
+            creating one from the ``pool_*`` and ``max_retries`` settings;
+            it can be shared between instances talking to the same hosts
+        metrics : None or Metrics
+            Counters updated by each request (see :meth:`stats`); a new
+            :class:`~pythonfinancier.metrics.Metrics` if None
         """
         self.logger = logging.getLogger(__name__)
         self.url = url
+        if rate_limiter is None:
+            rate_limiter = AimdRateLimiter()
+        self.rate_limiter = rate_limiter
+        self.session_file = session_file
+        if adapter is None:
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize,
+                                  pool_block=pool_block,
+                                  max_retries=max_retries)
+        self.adapter = adapter
+        self.keep_alive = keep_alive
+        self.timeouts = dict(self.TIMEOUTS, **(timeouts or {}))
+        self.compress_requests = compress_requests
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        # callables called around each request sent:
+        # before_request(op, method, url, kwargs) and
+        # after_request(op, method, url, kwargs, response, elapsed), where
+        # kwargs are the (uncompressed) arguments of the request
+        self.before_request = []
+        self.after_request = []
+        self.username = None
+        self.password = None
+        # name and roles of the logged in user
+        self.user_ctx = None
+        self.session_cookie = None
+        self.lock = threading.RLock()
         self.SESSION_URL = urljoin(self.url, self.SESSION)
         self.ALL_DBS_URL = urljoin(self.url, self.ALL_DBS)
         self.logger.debug('SESSION_URL: {}'.format(self.SESSION_URL))
 
+    def _new_session(self):
+        session = requests.session()
+        # the adapter (and its connection pools) outlives the sessions, so
+        # logging in again does not drop the open connections
+        session.mount(self.url, self.adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def set_credentials(self, username, password):
+        """
+        Set the credentials used to log in lazily, i.e. on the first request
+        (unless a saved session can be reused), and again whenever the
+        session has expired
+
+        Parameters
+        ----------
+        username : str
+        password : str
+        """
+        self.username = username
+        self.password = password
+
     def login(self, username, password):
         """
         Login to the database
@@ -50,14 +167,222 @@ class EasyCouchdb:
         -------
             Response to the login POST request
         """
-        self.req_session = requests.session()
-        self.req_session.mount(self.url, HTTPAdapter(max_retries=5))
-        return self.req_session.post(self.SESSION_URL,
-                                     data={'name': username,
-                                           'password': password},
-                                     timeout=self.TIMEOUT)
+        self.set_credentials(username, password)
+        with self.lock:
+            session = self._new_session()
+            res = self._send('login', 'post', self.SESSION_URL,
+                             session=session,
+                             data={'name': username,
+                                   'password': password})
+            self.req_session = session
+            if res.ok:
+                body = res.json()
+                self.user_ctx = {'name': body.get('name'),
+                                 'roles': body.get('roles', [])}
+                self._save_session()
+        return res
+
+    def _login(self):
+        """
+        Login with the stored credentials, raising a ConnectionError if it
+        fails
+        """
+        if self.username is None:
+            raise ConnectionError('Could not connect: no credentials')
+        login_json = self.login(self.username, self.password).json()
+        self.logger.debug('login_json: {}'.format(login_json))
+        if 'error' in login_json:
+            raise ConnectionError('Could not connect: ' + login_json[
+                'reason'])
+
+    def _ensure_session(self):
+        """
+        Make sure there is a session to send requests with: reuse the saved
+        session if it is still valid, or login
+        """
+        if self.req_session is not None:
+            return
+        with self.lock:
+            if self.req_session is None and not self._load_session():
+                self._login()
 
-    def all_docs(self, db_name):
+    def _load_session(self):
+        """
+        Restore the session saved in ``session_file``, if it belongs to this
+        server and user and has not expired
+
+        Returns
+        -------
+            Whether a session was restored
+        """
+        if self.session_file is None:
+            return False
+        try:
+            with open(self.session_file) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved.get('url') != self.url or \
+                saved.get('username') != self.username or \
+                saved.get('expires', 0) < time.time() + self.TIMEOUT:
+            return False
+        session = self._new_session()
+        session.cookies.set(self.SESSION_COOKIE, saved['cookie'], path='/')
+        self.session_cookie = saved['cookie']
+        self.user_ctx = saved['user_ctx']
+        self.req_session = session
+        self.logger.debug('reusing saved session of {0}'.format(
+            self.username))
+        return True
+
+    def _save_session(self):
+        """
+        Save the current session cookie (and user) to ``session_file``,
+        readable by the current user only
+        """
+        cookie = next((c for c in self.req_session.cookies
+                       if c.name == self.SESSION_COOKIE), None)
+        if cookie is None:
+            return
+        self.session_cookie = cookie.value
+        if self.session_file is None:
+            return
+        expires = cookie.expires or time.time() + self.SESSION_MAX_AGE
+        tmp_path = self.session_file + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'url': self.url,
+                       'username': self.username,
+                       'cookie': cookie.value,
+                       'expires': expires,
+                       'user_ctx': self.user_ctx}, f)
+        os.replace(tmp_path, self.session_file)
+
+    def session_info(self):
+        """
+        Get the name and roles of the logged in user (logging in first, if
+        needed)
+
+        Returns
+        -------
+            Dictionary with the ``name`` and ``roles`` of the user
+        """
+        self._ensure_session()
+        if self.user_ctx is None:
+            ctx = self._request('session', 'get',
+                                self.SESSION_URL).json()['userCtx']
+            self.user_ctx = {'name': ctx['name'], 'roles': ctx['roles']}
+        return self.user_ctx
+
+    def stats(self):
+        """
+        Get a snapshot of the request counters (count, latency histogram,
+        bytes sent and received, retries and status codes per operation)
+
+        Returns
+        -------
+            Dictionary (see :meth:`pythonfinancier.metrics.Metrics.snapshot`)
+        """
+        return self.metrics.snapshot()
+
+    def _request(self, op, method, url, **kwargs):
+        """
+        Send a request with the current session (logging in first if
+        needed, and again if the session has expired)
+
+        Parameters
+        ----------
+        op : str
+            Name of the operation (e.g. 'query'), which selects the timeout
+            and labels the metrics
+        method : str
+            HTTP method ('get', 'post', ...)
+        url : str
+            Full url of the request
+        kwargs
+            Passed on to :meth:`requests.Session.request`
+
+        Returns
+        -------
+            Response of the request
+        """
+        self._ensure_session()
+        session = self.req_session
+        res = self._send(op, method, url, session=session, **kwargs)
+        if res.status_code == 401 and self.username is not None:
+            with self.lock:
+                # another thread may have logged in again already
+                if self.req_session is session:
+                    self.logger.info('session expired, logging in again')
+                    self._login()
+            self.metrics.record_retry(op)
+            res = self._send(op, method, url, session=self.req_session,
+                             **kwargs)
+        cookie = res.cookies.get(self.SESSION_COOKIE)
+        if cookie is not None and cookie != self.session_cookie:
+            # the server refreshed the session cookie
+            with self.lock:
+                self._save_session()
+        return res
+
+    def _send(self, op, method, url, session, **kwargs):
+        """
+        Send a request through the rate limiter, repeating it (a few times)
+        if the server answers that it is overloaded. Large JSON bodies are
+        gzipped if ``compress_requests`` is set.
+
+        Parameters
+        ----------
+        op : str
+            Name of the operation (e.g. 'query'), which selects the timeout
+            and labels the metrics
+        method : str
+            HTTP method ('get', 'post', ...)
+        url : str
+            Full url of the request
+        session : requests.Session
+            Session used to send the request
+        kwargs
+            Passed on to :meth:`requests.Session.request`
+
+        Returns
+        -------
+            Response of the request
+        """
+        kwargs.setdefault('timeout', self.timeouts.get(op, self.TIMEOUT))
+        request_kwargs = dict(kwargs)
+        if self.compress_requests and 'json' in kwargs:
+            body = json.dumps(kwargs.pop('json')).encode('utf-8')
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers['Content-Type'] = 'application/json'
+            if len(body) >= self.COMPRESS_MIN_SIZE:
+                body = gzip.compress(body)
+                headers['Content-Encoding'] = 'gzip'
+            kwargs['data'] = body
+            kwargs['headers'] = headers
+        for attempt in range(self.BACKOFF_RETRIES + 1):
+            self.rate_limiter.acquire()
+            for hook in self.before_request:
+                hook(op, method, url, request_kwargs)
+            start = time.monotonic()
+            res = session.request(method, url, **kwargs)
+            elapsed = time.monotonic() - start
+            retry_after = retry_after_seconds(res.headers.get('Retry-After'))
+            self.rate_limiter.feedback(res.status_code, elapsed, retry_after)
+            self.metrics.record_request(op, res.status_code, elapsed,
+                                        len(res.request.body or b''),
+                                        len(res.content))
+            for hook in self.after_request:
+                hook(op, method, url, request_kwargs, res, elapsed)
+            if res.status_code not in AimdRateLimiter.BACKOFF_STATUS:
+                break
+            if attempt < self.BACKOFF_RETRIES:
+                self.metrics.record_retry(op)
+            self.logger.info('{0} {1} answered {2} (attempt {3})'.format(
+                method.upper(), url, res.status_code, attempt + 1))
+        return res
+
+    def all_docs(self, db_name, keys=None, **params):
         """
         Get all documents from the CouchDB instance
 
@@ -65,14 +390,23 @@ class EasyCouchdb:
         ----------
         db_name : str
             Name of the database to query
+        keys : None or list
+            If given, only the rows for these document ids are returned
+            (in a single POST request)
+        params
+            Other query parameters of ``_all_docs`` (e.g. ``include_docs``,
+            ``startkey``, ``endkey``, ``limit``); values are JSON-encoded
 
         Returns
         -------
-            Response to the all_docs GET request
+            Response to the all_docs request
         """
-        return self.req_session.get(
-            urljoin(self.url, '/'.join([db_name, self.ALL_DOCS])),
-            timeout=self.TIMEOUT)
+        url = urljoin(self.url, '/'.join([db_name, self.ALL_DOCS]))
+        params = {k: json.dumps(v) for k, v in params.items()}
+        if keys is not None:
+            return self._request('all_docs', 'post', url, params=params,
+                                 json={'keys': keys})
+        return self._request('all_docs', 'get', url, params=params)
 
     def query(self, db_name, selector):
         """
@@ -90,14 +424,44 @@ class EasyCouchdb:
         ret : list
             List of the documents that match the given query
         """
-        sleep(0.5)
         self.logger.debug('executing query: {0}'.format(selector))
-        ret = self.req_session.post(
-            urljoin(self.url, '/'.join([db_name, self.FIND])), json=selector,
-            timeout=self.TIMEOUT)
+        ret = self._request(
+            'query', 'post',
+            urljoin(self.url, '/'.join([db_name, self.FIND])),
+            json=selector)
         self.logger.debug('query executed')
         return ret
 
+    def iter_query(self, db_name, query, page_size=200):
+        """
+        Run a query page by page (following the ``bookmark`` of each
+        response), yielding the documents as the pages arrive
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database to query
+        query : dict
+            Body of the ``_find`` request (``selector``, optionally
+            ``fields``, ``sort``...); its ``limit`` is replaced by
+            ``page_size``
+        page_size : int
+            Number of documents requested per page
+
+        Returns
+        -------
+            Generator of the matching documents
+        """
+        query = dict(query, limit=page_size)
+        while True:
+            res = self.query(db_name, query)
+            res.raise_for_status()
+            page = res.json()
+            yield from page['docs']
+            if len(page['docs']) < page_size or not page.get('bookmark'):
+                return
+            query['bookmark'] = page['bookmark']
+
     def insert(self, db_name, doc):
         """
         Insert a document into the database
@@ -113,11 +477,10 @@ class EasyCouchdb:
         -------
             Response of the POST request for the insertion
         """
-        sleep(0.5)
         self.logger.debug('inserting ' +
                           str(urljoin(self.url, db_name)))
-        return self.req_session.post(urljoin(self.url, db_name), json=doc,
-                                     timeout=self.TIMEOUT)
+        return self._request('insert', 'post', urljoin(self.url, db_name),
+                             json=doc)
 
     def save(self, db_name, doc):
         """
@@ -134,12 +497,13 @@ class EasyCouchdb:
         -------
             Response of the PUT request for the document update
         """
-        sleep(0.5)
         self.logger.debug('putting ' +
                           str(urljoin(self.url, '/'.join([db_name,
                                                           doc['_id']]))))
-        return self.req_session.put(
-            urljoin(self.url, '/'.join([db_name, doc['_id']])), json=doc)
+        return self._request(
+            'save', 'put',
+            urljoin(self.url, '/'.join([db_name, doc['_id']])),
+            json=doc)
 
     def get_doc(self, db_name, _id):
         """
@@ -156,9 +520,158 @@ class EasyCouchdb:
         -------
             Response of the GET request for the document retrieval
         """
-        sleep(0.5)
         self.logger.debug('getting ' +
                           str(urljoin(self.url, '/'.join([db_name, _id]))))
-        return self.req_session.get(
-            urljoin(self.url, '/'.join([db_name, _id])),
-            timeout=self.TIMEOUT)
+        return self._request(
+            'get_doc', 'get', urljoin(self.url, '/'.join([db_name, _id])))
+
+    def bulk_docs(self, db_name, docs):
+        """
+        Insert or update several documents with a single request
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database into which to write
+        docs : list
+            List of JSON-formatted dictionaries of the documents to write
+
+        Returns
+        -------
+            Response of the POST request; its JSON body holds one
+            ``{'ok', 'id', 'rev'}`` or ``{'id', 'error', 'reason'}`` result
+            per document, in the same order as ``docs``
+        """
+        self.logger.debug('bulk writing {0} docs to {1}'.format(
+            len(docs), db_name))
+        return self._request(
+            'bulk_docs', 'post',
+            urljoin(self.url, '/'.join([db_name, self.BULK_DOCS])),
+            json={'docs': docs})
+
+    def bulk_get(self, db_name, ids):
+        """
+        Get several documents with a single request
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database from which to get the documents
+        ids : list
+            ID values of the documents
+
+        Returns
+        -------
+            Response of the POST request; its JSON body holds one result
+            per id (in the same order), whose ``docs`` list holds either
+            ``{'ok': doc}`` or ``{'error': {...}}``. Servers older than
+            CouchDB 2.0 answer 404 or 405 (see :meth:`all_docs` with
+            ``include_docs``).
+        """
+        return self._request(
+            'bulk_get', 'post',
+            urljoin(self.url, '/'.join([db_name, self.BULK_GET])),
+            json={'docs': [{'id': _id} for _id in ids]})
+
+    def db_info(self, db_name):
+        """
+        Get information about a database (document count, ``update_seq``,
+        ...)
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database
+
+        Returns
+        -------
+            Response of the GET request
+        """
+        return self._request('db_info', 'get', urljoin(self.url, db_name))
+
+    def changes(self, db_name, since=0, limit=None, include_docs=False):
+        """
+        Get the changes made to a database since a given sequence
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database
+        since : str or int
+            Sequence after which changes are returned (0 for all of them)
+        limit : None or int
+            Maximum number of changes returned
+        include_docs : bool
+            Whether to include the current version of each changed document
+
+        Returns
+        -------
+            Response of the GET request; its JSON body has the
+            ``results`` and the ``last_seq`` to resume from
+        """
+        params = {'since': since}
+        if limit is not None:
+            params['limit'] = limit
+        if include_docs:
+            params['include_docs'] = 'true'
+        return self._request(
+            'changes', 'get',
+            urljoin(self.url, '/'.join([db_name, self.CHANGES])),
+            params=params)
+
+    def view(self, db_name, ddoc, view, **params):
+        """
+        Query a map/reduce view
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database to query
+        ddoc : str
+            Name of the design document (without ``_design/``)
+        view : str
+            Name of the view
+        params
+            Query parameters of the view (e.g. ``group_level``,
+            ``startkey``, ``endkey``); values are JSON-encoded
+
+        Returns
+        -------
+            Response of the GET request; its JSON body holds the ``rows``
+            (``key`` and ``value``)
+        """
+        url = urljoin(self.url, '/'.join([db_name, '_design', ddoc, '_view',
+                                          view]))
+        return self._request('view', 'get', url, params={
+            k: json.dumps(v) for k, v in params.items()})
+
+    def create_index(self, db_name, fields, name=None, ddoc=None):
+        """
+        Create a Mango index (nothing happens if it already exists)
+
+        Parameters
+        ----------
+        db_name : str
+            Name of the database in which to create the index
+        fields : list
+            Names of the indexed fields
+        name : None or str
+            Name of the index
+        ddoc : None or str
+            Name of the design document holding the index
+
+        Returns
+        -------
+            Response of the POST request; its JSON body has a ``result`` of
+            ``'created'`` or ``'exists'``
+        """
+        index = {'index': {'fields': fields}, 'type': 'json'}
+        if name is not None:
+            index['name'] = name
+        if ddoc is not None:
+            index['ddoc'] = ddoc
+        self.logger.debug('creating index {0}'.format(index))
+        return self._request(
+            'create_index', 'post',
+            urljoin(self.url, '/'.join([db_name, self.INDEX])),
+            json=index)
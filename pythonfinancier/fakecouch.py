@@ -0,0 +1,448 @@
+"""
+An in-process stand-in for the parts of CouchDB used by python-financier
+(``_session``, ``_find``, ``_all_docs``, ``_bulk_docs``, ``_bulk_get``,
+``_changes`` and document GET/PUT/POST/DELETE), with an optional latency
+injected in every request. It keeps everything in memory and is meant for
+benchmarks and experiments, not as a database:
+
+    with FakeCouchServer(latency=0.02) as server:
+        user_db = server.add_user('user', 'password')
+        server.put(user_db, {'_id': 'budget_...', 'name': 'Personal'})
+        f = Financier(url_couch_db=server.url, username='user',
+                      password='password')
+"""
+
+import gzip
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+_MISSING = object()
+
+
+def _field(doc, path):
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _cmp_ok(value, op, arg):
+    if value is _MISSING:
+        return op == '$exists' and not arg
+    try:
+        if op == '$eq':
+            return value == arg
+        if op == '$ne':
+            return value != arg
+        if op == '$gt':
+            return value > arg
+        if op == '$gte':
+            return value >= arg
+        if op == '$lt':
+            return value < arg
+        if op == '$lte':
+            return value <= arg
+        if op == '$in':
+            return value in arg
+        if op == '$nin':
+            return value not in arg
+        if op == '$exists':
+            return bool(arg)
+        if op == '$regex':
+            return isinstance(value, str) and re.search(arg, value) is not None
+        if op == '$elemMatch':
+            return isinstance(value, list) and any(
+                matches(v, arg) for v in value)
+    except TypeError:
+        return False
+    raise ValueError('unsupported operator {0}'.format(op))
+
+
+def matches(doc, selector):
+    """
+    Whether ``doc`` satisfies the Mango ``selector``
+    """
+    for key, cond in selector.items():
+        if key == '$and':
+            if not all(matches(doc, s) for s in cond):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, s) for s in cond):
+                return False
+        elif key == '$not':
+            if matches(doc, cond):
+                return False
+        else:
+            value = _field(doc, key)
+            if isinstance(cond, dict) and cond and all(
+                    k.startswith('$') for k in cond):
+                for op, arg in cond.items():
+                    if not _cmp_ok(value, op, arg):
+                        return False
+            elif value is _MISSING or value != cond:
+                return False
+    return True
+
+
+class FakeCouchState:
+    """
+    Users, sessions and databases of a FakeCouchServer
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}
+        self.sessions = {}
+        self.dbs = {}
+        # number of requests received
+        self.requests = 0
+
+    def db(self, name):
+        """
+        Get (creating it if needed) the database ``name``: its ``docs`` by
+        id, its update ``seq`` and the ``changes`` (last seq of each doc)
+        """
+        return self.dbs.setdefault(name, {'docs': {}, 'seq': 0,
+                                          'changes': {}})
+
+
+def write_doc(db, doc, new_edits=True):
+    """
+    Write a document into a database of a FakeCouchState, the way CouchDB
+    does: a new revision is given unless ``new_edits`` is False, and an
+    update of an existing document must give its current ``_rev``
+
+    Returns
+    -------
+        Result of the write (``ok``, ``id`` and ``rev``, or ``error``)
+    """
+    doc = dict(doc)
+    doc_id = doc.setdefault('_id', uuid.uuid4().hex)
+    current = db['docs'].get(doc_id)
+    if new_edits:
+        if current is not None and not current.get('_deleted') and \
+                doc.get('_rev') != current['_rev']:
+            return {'id': doc_id, 'error': 'conflict',
+                    'reason': 'Document update conflict.'}
+        n = int(current['_rev'].split('-')[0]) + 1 if current else 1
+        doc['_rev'] = '{0}-{1}'.format(n, uuid.uuid4().hex)
+    db['docs'][doc_id] = doc
+    db['seq'] += 1
+    db['changes'].pop(doc_id, None)
+    db['changes'][doc_id] = db['seq']
+    return {'ok': True, 'id': doc_id, 'rev': doc['_rev']}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Request handler of a FakeCouchServer
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately: without this, each response
+    # of a kept-alive connection waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        ct = self.headers.get('Content-Type', '')
+        if not raw:
+            return {}
+        if 'json' in ct:
+            return json.loads(raw.decode())
+        return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and \
+                len(data) > 1024:
+            data = gzip.compress(data)
+            self.send_header('Content-Encoding', 'gzip')
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _user(self):
+        cookie = self.headers.get('Cookie', '')
+        m = re.search(r'AuthSession=([^;]+)', cookie)
+        if m:
+            return self.state.sessions.get(m.group(1))
+
+    def _handle(self, method):
+        time.sleep(self.server.latency)
+        with self.state.lock:
+            self.state.requests += 1
+        url = urlparse(self.path)
+        prefix = self.server.prefix
+        path = url.path
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+        parts = [unquote(p) for p in path.strip('/').split('/') if p]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self._body() if method in ('POST', 'PUT') else {}
+
+        if parts == ['_session']:
+            if method == 'POST':
+                name = body.get('name')
+                user = self.state.users.get(name)
+                if not user or user['password'] != body.get('password'):
+                    return self._send(401, {
+                        'error': 'unauthorized',
+                        'reason': 'Name or password is incorrect.'})
+                token = uuid.uuid4().hex
+                self.state.sessions[token] = name
+                return self._send(
+                    200, {'ok': True, 'name': name, 'roles': user['roles']},
+                    {'Set-Cookie': 'AuthSession={0}; Version=1; Path=/; '
+                                   'HttpOnly; Max-Age=600'.format(token)})
+            name = self._user()
+            return self._send(200, {'ok': True, 'userCtx': {
+                'name': name,
+                'roles': self.state.users[name]['roles'] if name else []}})
+
+        name = self._user()
+        if name is None:
+            return self._send(401, {'error': 'unauthorized',
+                                    'reason': 'You are not authorized'})
+        if not parts:
+            return self._send(200, {'couchdb': 'Welcome'})
+        with self.state.lock:
+            db = self.state.db(parts[0])
+            return self._db_request(method, db, parts[1:], query, body)
+
+    def _db_request(self, method, db, parts, query, body):
+        if not parts:
+            if method == 'GET':
+                return self._send(200, {'db_name': 'db',
+                                        'doc_count': len(db['docs']),
+                                        'update_seq': str(db['seq'])})
+            if method == 'POST':
+                return self._send(201, write_doc(db, body))
+        op = parts[0]
+        if op == '_find':
+            return self._find(db, body)
+        if op == '_index':
+            return self._send(200, {'result': 'created',
+                                    'id': '_design/x', 'name': 'x'})
+        if op == '_all_docs':
+            return self._all_docs(db, query, body)
+        if op == '_bulk_docs':
+            new_edits = body.get('new_edits', True)
+            return self._send(201, [write_doc(db, d, new_edits)
+                                    for d in body.get('docs', [])])
+        if op == '_bulk_get':
+            results = []
+            for ref in body.get('docs', []):
+                doc = db['docs'].get(ref['id'])
+                if doc is None or doc.get('_deleted'):
+                    results.append({'id': ref['id'], 'docs': [{'error': {
+                        'id': ref['id'], 'error': 'not_found',
+                        'reason': 'missing'}}]})
+                else:
+                    results.append({'id': ref['id'],
+                                    'docs': [{'ok': doc}]})
+            return self._send(200, {'results': results})
+        if op == '_changes':
+            return self._changes(db, query, body)
+        doc_id = '/'.join(parts)
+        if method == 'GET':
+            doc = db['docs'].get(doc_id)
+            if doc is None or doc.get('_deleted'):
+                return self._send(404, {'error': 'not_found',
+                                        'reason': 'missing'})
+            return self._send(200, doc)
+        if method == 'PUT':
+            body['_id'] = doc_id
+            res = write_doc(db, body)
+            return self._send(409 if 'error' in res else 201, res)
+        if method == 'DELETE':
+            res = write_doc(db, {'_id': doc_id, '_rev': query.get('rev'),
+                                   '_deleted': True})
+            return self._send(409 if 'error' in res else 200, res)
+        return self._send(405, {'error': 'method_not_allowed'})
+
+    def _find(self, db, body):
+        selector = body.get('selector', {})
+        limit = body.get('limit', 25)
+        skip = int(body.get('bookmark') or 0)
+        fields = body.get('fields')
+        hits = [d for k, d in sorted(db['docs'].items())
+                if not d.get('_deleted') and matches(d, selector)]
+        page = hits[skip:skip + limit]
+        if fields:
+            page = [{f: d[f] for f in fields if f in d} for d in page]
+        return self._send(200, {'docs': page,
+                                'bookmark': str(skip + len(page))})
+
+    def _all_docs(self, db, query, body):
+        params = dict(query)
+        params.update(body)
+
+        def load(key):
+            v = params.get(key)
+            return json.loads(v) if isinstance(v, str) else v
+
+        include_docs = str(params.get('include_docs')).lower() == 'true'
+        keys = load('keys')
+        if keys is not None:
+            rows = []
+            for key in keys:
+                doc = db['docs'].get(key)
+                if doc is None:
+                    rows.append({'key': key, 'error': 'not_found'})
+                elif doc.get('_deleted'):
+                    rows.append({'id': key, 'key': key, 'value': {
+                        'rev': doc['_rev'], 'deleted': True}, 'doc': None})
+                else:
+                    row = {'id': key, 'key': key,
+                           'value': {'rev': doc['_rev']}}
+                    if include_docs:
+                        row['doc'] = doc
+                    rows.append(row)
+            return self._send(200, {'total_rows': len(db['docs']),
+                                    'rows': rows})
+        start = load('startkey') or load('start_key')
+        end = load('endkey') or load('end_key')
+        limit = load('limit')
+        skip = load('skip') or 0
+        rows = []
+        for k in sorted(db['docs']):
+            doc = db['docs'][k]
+            if doc.get('_deleted'):
+                continue
+            if start is not None and k < start:
+                continue
+            if end is not None and k > end:
+                continue
+            row = {'id': k, 'key': k, 'value': {'rev': doc['_rev']}}
+            if include_docs:
+                row['doc'] = doc
+            rows.append(row)
+        rows = rows[skip:]
+        if limit is not None:
+            rows = rows[:limit]
+        return self._send(200, {'total_rows': len(db['docs']),
+                                'offset': skip, 'rows': rows})
+
+    def _changes(self, db, query, body):
+        since = int(str(query.get('since', 0)).split('-')[0] or 0) \
+            if query.get('since') != 'now' else db['seq']
+        limit = int(query['limit']) if 'limit' in query else None
+        include_docs = query.get('include_docs') == 'true'
+        results = []
+        for doc_id, seq in sorted(db['changes'].items(), key=lambda i: i[1]):
+            if seq <= since:
+                continue
+            doc = db['docs'][doc_id]
+            row = {'seq': str(seq), 'id': doc_id,
+                   'changes': [{'rev': doc['_rev']}]}
+            if doc.get('_deleted'):
+                row['deleted'] = True
+            if include_docs:
+                row['doc'] = doc
+            results.append(row)
+            if limit is not None and len(results) >= limit:
+                break
+        last = results[-1]['seq'] if results else str(max(since, 0))
+        return self._send(200, {'results': results, 'last_seq': last,
+                                'pending': 0})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class FakeCouchServer:
+    """
+    Fake CouchDB server, listening on a free local port in a background
+    thread (use it as a context manager, or call :meth:`start` and
+    :meth:`stop`)
+    """
+
+    def __init__(self, latency=0.0, prefix='/db'):
+        """
+        Parameters
+        ----------
+        latency : float
+            Delay in seconds added to every request
+        prefix : str
+            Path under which the server answers (like a CouchDB behind a
+            reverse proxy, as on financier.io)
+        """
+        self.state = FakeCouchState()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.httpd.latency = latency
+        self.httpd.prefix = prefix
+        self.url = 'http://127.0.0.1:{0}{1}/'.format(
+            self.httpd.server_address[1], prefix)
+        self.thread = None
+
+    def add_user(self, name, password):
+        """
+        Create a user, with a ``userdb-<hex name>`` role as on financier.io
+
+        Returns
+        -------
+            Name of the user's database
+        """
+        self.state.users[name] = {'password': password,
+                                  'roles': ['userdb-' + name.encode().hex()]}
+        return self.state.users[name]['roles'][0]
+
+    def put(self, db_name, doc):
+        """
+        Write a document directly into a database (without a request)
+
+        Returns
+        -------
+            Result of the write (see :func:`write_doc`)
+        """
+        with self.state.lock:
+            return write_doc(self.state.db(db_name), doc)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -3,9 +3,26 @@ This module allows you insert transactions and payees on Financier
 """
 
 from pythonfinancier.easycouchdb import EasyCouchdb
+from pythonfinancier.cache import LRUCache, MetadataCache
+from pythonfinancier.payeeindex import PayeeIndex
+from pythonfinancier.tracing import Trace
+from pythonfinancier.writer import BufferedWriter
+from pythonfinancier import views
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+import datetime
 import uuid
 import configparser
+import json
 import logging
+import threading
+
+# category values of transactions that are not category ids
+SPECIAL_CATEGORIES = ('income', 'incomeNextMonth', 'split')
+# namespace of the uuid5 values used for deterministic transaction ids
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL,
+                          'https://github.com/jat255/python-financier')
 
 
 def split_id(full_id):
@@ -25,18 +42,81 @@ def split_id(full_id):
     return full_id.split('_')[-1]
 
 
+def id_range(prefix):
+    """
+    Build a selector condition matching the ids starting with ``prefix``.
+    Unlike a ``$regex``, a range on ``_id`` is served by the primary index,
+    so its cost depends on the number of matching documents rather than on
+    the size of the database.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix of the ids to match (e.g. "b_<BUDGET UUID4>_account_")
+
+    Returns
+    -------
+        Dictionary to use as the ``_id`` condition of a Mango selector
+    """
+    return {'$gt': prefix, '$lt': prefix + '\ufff0'}
+
+
+def chunk_docs(docs, batch_size=500, max_bytes=1000000):
+    """
+    Group documents into batches suitable for a ``_bulk_docs`` request
+
+    Parameters
+    ----------
+    docs : iterable
+        Documents (dicts) to group; consumed lazily
+    batch_size : int
+        Maximum number of documents in one batch
+    max_bytes : int
+        Approximate maximum size (in bytes of JSON) of one batch. A single
+        document larger than this is still sent, alone in its batch.
+
+    Returns
+    -------
+        Generator of lists of documents
+    """
+    batch = []
+    size = 0
+    for doc in docs:
+        doc_size = len(json.dumps(doc))
+        if batch and (len(batch) >= batch_size or
+                      size + doc_size > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(doc)
+        size += doc_size
+    if batch:
+        yield batch
+
+
 class Financier:
     """
     A class to more easily interact with a Financier user's database
     """
 
     selector = {}
+    # Mango indexes created by ensure_indexes (fields of each index)
+    INDEXES = [['name'], ['date'], ['value'], ['account', 'date'],
+               ['payee', 'date'], ['category', 'date']]
+    INDEX_DDOC = 'python-financier'
 
     def __init__(self,
                  conf_file='python-financier.ini',
                  url_couch_db=None,
                  username=None,
-                 password=None):
+                 password=None,
+                 rate_limiter=None,
+                 cache_dir=None,
+                 session_file=None,
+                 couchdb_options=None,
+                 map_size=None,
+                 map_ttl=None,
+                 fuzzy_payees=False):
         """
         Create a new instance of the Financier class
 
@@ -53,35 +133,188 @@ class Financier:
         password : None or str
             If None, value is read from config file 'python-financier.ini'
             If string, password to login with
+        rate_limiter : None or TokenBucket
+            Limiter pacing the requests to the database (see
+            :class:`~pythonfinancier.easycouchdb.EasyCouchdb`)
+        cache_dir : None or str
+            If given, the account, category and payee maps of each budget
+            are kept in a file in this directory, and only the changes made
+            since it was written are loaded when connecting to the budget
+        session_file : None or str
+            If given, the login session is saved to this (private) file and
+            reused by later instances until it expires, so they start
+            without logging in. In any case, logging in only happens on the
+            first request, and again if the session expires.
+        couchdb_options : None or dict
+            Other settings of the connection (e.g. ``pool_maxsize``,
+            ``timeouts`` or ``compress_requests``), passed on to
+            :class:`~pythonfinancier.easycouchdb.EasyCouchdb`
+        map_size : None or int
+            Maximum number of entries of each of the account, category and
+            payee maps (the least recently used ones are dropped); unbounded
+            if None
+        map_ttl : None or float
+            Number of seconds after which a map entry is looked up again in
+            the database; never if None
+        fuzzy_payees : bool
+            Resolve payee names through the :meth:`payee_index`, so that
+            variants of an existing payee's name (e.g. "CARREFOUR 123" for
+            "Carrefour") are matched to it instead of creating a new payee
         """
-        config = configparser.ConfigParser()
-
-        if url_couch_db is None:
+        if url_couch_db is None or username is None or password is None:
+            config = configparser.ConfigParser()
             config.read(conf_file)
-            url_couch_db = config['Financier']['url_couch_db']
-        if username is None:
-            config.read(conf_file)
-            username = config['Financier']['username']
-        if password is None:
-            config.read(conf_file)
-            password = config['Financier']['password']
+            settings = config['Financier']
+            if url_couch_db is None:
+                url_couch_db = settings['url_couch_db']
+            if username is None:
+                username = settings['username']
+            if password is None:
+                password = settings['password']
 
         self.logger = logging.getLogger(__name__)
 
-        self.cdb = EasyCouchdb(url_couch_db)
-        self.login_json = self.cdb.login(username, password).json()
-        self.logger.debug('login_json: {}'.format(self.login_json))
-        if 'error' in self.login_json:
-            raise ConnectionError('Could not connect: ' + self.login_json[
-                'reason'])
-        roles = self.login_json['roles']
-
-        self.user_db = next(r for r in roles if r.startswith('userdb'))
-        self.account_map = {}
-        self.category_map = {}
-        self.payee_map = {}
+        # nothing is sent to the server until the first request, which logs
+        # in (or reuses the session saved in session_file)
+        self.cdb = EasyCouchdb(url_couch_db, rate_limiter=rate_limiter,
+                               session_file=session_file,
+                               **(couchdb_options or {}))
+        self.cdb.set_credentials(username, password)
+        # request counters, also counting the hits and misses of the maps
+        self.metrics = self.cdb.metrics
+        # active traces (see trace)
+        self._traces = []
+        self._user_db = None
+        self.account_map = LRUCache(map_size, map_ttl)
+        self.category_map = LRUCache(map_size, map_ttl)
+        self.payee_map = LRUCache(map_size, map_ttl)
+        # payee lookups in flight, by name (see get_or_create_payee)
+        self._payee_lock = threading.Lock()
+        self._pending_payees = {}
+        self.fuzzy_payees = fuzzy_payees
+        self._payee_index = None
+        self._payee_index_lock = threading.Lock()
+        # active BufferedWriter (see buffered)
+        self._writer = None
         self.budget_selector = ''
-        self.logger.debug('Connecting on db {0}'.format(self.user_db))
+        self.cache_dir = cache_dir
+        self.cache = None
+        # database sequence the maps are up to date with (when cached)
+        self.update_seq = None
+
+    @property
+    def login_json(self):
+        """
+        Name and roles of the logged in user (logging in if needed)
+        """
+        return self.cdb.session_info()
+
+    @property
+    def user_db(self):
+        """
+        Name of the user's database (logging in if needed)
+        """
+        if self._user_db is None:
+            roles = self.login_json['roles']
+            self._user_db = next(r for r in roles if r.startswith('userdb'))
+            self.logger.debug('Connecting on db {0}'.format(self._user_db))
+        return self._user_db
+
+    def stats(self):
+        """
+        Get a snapshot of the metrics: the requests sent per operation
+        (count, latency histogram, bytes, retries and status codes) and the
+        hits and misses of the account, category and payee maps
+
+        Returns
+        -------
+            Dictionary (see :meth:`pythonfinancier.metrics.Metrics.snapshot`)
+        """
+        return self.metrics.snapshot()
+
+    @contextmanager
+    def trace(self):
+        """
+        Record the requests sent and the map lookups made inside a ``with``
+        block:
+
+            with f.trace() as t:
+                f.save_split(...)
+            t.calls, t.lookups, t.summary()
+
+        Returns
+        -------
+            Context manager giving a :class:`~pythonfinancier.tracing.Trace`
+        """
+        trace = Trace()
+        self.cdb.after_request.append(trace.after_request)
+        self._traces.append(trace)
+        try:
+            yield trace
+        finally:
+            self._traces.remove(trace)
+            self.cdb.after_request.remove(trace.after_request)
+
+    @contextmanager
+    def buffered(self, max_docs=500, max_delay=0.5):
+        """
+        Buffer the transactions saved inside a ``with`` block (from any
+        thread), writing them with ``_bulk_docs`` in batches of up to
+        ``max_docs`` documents, at most ``max_delay`` seconds after they are
+        saved, and when the block ends:
+
+            with f.buffered() as writer:
+                future = f.save_transaction(...)
+                writer.flush()  # optional
+            future.result()
+
+        Inside the block, :meth:`save_transaction`, :meth:`save_split` and
+        :meth:`save_transfer` return Futures (of the ``_bulk_docs`` result
+        of each document, or None if it had already been imported) instead
+        of responses.
+
+        Parameters
+        ----------
+        max_docs : int
+            Number of waiting documents that triggers a write
+        max_delay : float
+            Maximum number of seconds a document waits before being written
+
+        Returns
+        -------
+            Context manager giving the
+            :class:`~pythonfinancier.writer.BufferedWriter`
+        """
+        if self._writer is not None:
+            raise ValueError('transactions are already buffered')
+        writer = BufferedWriter(self.cdb, self.user_db, max_docs=max_docs,
+                                max_delay=max_delay)
+        self._writer = writer
+        try:
+            yield writer
+        finally:
+            self._writer = None
+            writer.close()
+
+    def _record_lookup(self, kind, name, from_map):
+        self.metrics.record_lookup(kind, from_map)
+        for trace in self._traces:
+            trace.lookup(kind, name, from_map)
+
+    def ensure_indexes(self):
+        """
+        Create the Mango indexes on the fields the ``find_*`` methods filter
+        by (see ``INDEXES``), if they do not exist yet. This only needs to be
+        done once per user database.
+
+        Returns
+        -------
+            List of the JSON responses, one per index
+        """
+        return [self.cdb.create_index(self.user_db, fields,
+                                      name='-'.join(fields),
+                                      ddoc=self.INDEX_DDOC).json()
+                for fields in self.INDEXES]
 
     def get_all_budgets(self):
         """
@@ -92,11 +325,14 @@ class Financier:
             List of the budgets as json objects, each containing the ``name``
             and ``_id`` of the budget
         """
-        return self.cdb.query(self.user_db,
-                              {'selector': {'_id': {'$regex': '^budget_'}},
-                               'fields': ['_id', 'name']}).json()['docs']
-
-    def connect_budget(self, name):
+        rows = self.cdb.all_docs(self.user_db,
+                                 startkey='budget_',
+                                 endkey='budget_\ufff0',
+                                 include_docs=True).json()['rows']
+        return [{'_id': r['doc']['_id'], 'name': r['doc'].get('name')}
+                for r in rows if r.get('doc')]
+
+    def connect_budget(self, name, preload=False):
         """
         Set a particular budget as "active" within the Financier class
 
@@ -104,6 +340,11 @@ class Financier:
         ----------
         name : str
             Name of the budget to use (must be an exact match)
+        preload : bool
+            If True, load every account, category and payee of the budget
+            into the local maps right away (see :meth:`refresh_maps`), so
+            later name lookups do not need the database (always done when
+            a ``cache_dir`` is used)
         """
         budget = self.find_budget(name)
         if budget:
@@ -113,6 +354,152 @@ class Financier:
         else:
             raise Exception('Budget not found')
 
+        # the maps of a previously connected budget are no longer valid
+        self.account_map.clear()
+        self.category_map.clear()
+        self.payee_map.clear()
+        self._payee_index = None
+        self.update_seq = None
+        if self.cache_dir is not None:
+            self.cache = MetadataCache.for_budget(
+                self.cache_dir, self.user_db, self.budget_selector)
+            self.load_cache()
+        elif preload:
+            self.refresh_maps()
+
+    def _maps(self):
+        return {'account': self.account_map,
+                'category': self.category_map,
+                'payee': self.payee_map}
+
+    @staticmethod
+    def _map_entry(kind, doc):
+        """
+        Build the map entry (doc dictionary with bare ``_id``) of an account,
+        category or payee document
+        """
+        entry = {'_id': split_id(doc['_id']), 'name': doc['name']}
+        if kind == 'payee':
+            entry['categorySuggest'] = doc.get('categorySuggest')
+        return entry
+
+    def refresh_maps(self):
+        """
+        (Re)load the account, category and payee maps of the active budget,
+        with one ``_all_docs`` range scan per document type instead of one
+        query per name. If a cache is used, it is rewritten.
+        """
+        if self.cache is not None:
+            # changes made during the scan will be applied again on the
+            # next update, which is harmless
+            self.update_seq = self.cdb.db_info(
+                self.user_db).json()['update_seq']
+        for kind, name_map in self._maps().items():
+            name_map.clear()
+            for doc in self.prefix_docs(kind):
+                if doc.get('name') is None or doc['name'] in name_map:
+                    continue
+                name_map[doc['name']] = self._map_entry(kind, doc)
+            self.logger.debug('loaded {0} {1} entries'.format(
+                len(name_map), kind))
+        if self.cache is not None:
+            self.cache.save(self.update_seq, self._maps())
+
+    def load_cache(self):
+        """
+        Load the maps of the active budget from the cache file and apply
+        the changes made in the database since it was written. Without a
+        usable cache file, the maps are fully loaded (and cached).
+        """
+        cached = self.cache.load()
+        if cached is None:
+            self.logger.info('no cache in {0}, loading maps'.format(
+                self.cache.path))
+            self.refresh_maps()
+            return
+        self.update_seq, maps = cached
+        for kind, name_map in self._maps().items():
+            name_map.clear()
+            name_map.update(maps.get(kind, {}))
+        self.update_maps()
+
+    def update_maps(self, batch_size=1000):
+        """
+        Apply the changes made in the database since the maps were loaded
+        (``update_seq``), then save them to the cache (if one is used).
+        Renamed or deleted accounts, categories and payees are corrected;
+        other changes (e.g. transactions) are skipped.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of changes read per request
+        """
+        if self.update_seq is None:
+            self.refresh_maps()
+            return
+        maps = self._maps()
+        prefixes = {'{0}_{1}_'.format(self.budget_selector, kind): kind
+                    for kind in maps}
+        # bare id -> name, to find the entries of renamed/deleted docs
+        names = {kind: {e['_id']: n for n, e in name_map.items()}
+                 for kind, name_map in maps.items()}
+        applied = 0
+        while True:
+            res = self.cdb.changes(self.user_db, since=self.update_seq,
+                                   limit=batch_size).json()
+            changed = {}
+            for row in res['results']:
+                kind = next((k for p, k in prefixes.items()
+                             if row['id'].startswith(p)), None)
+                if kind is not None:
+                    changed[row['id']] = kind
+            # fetch only the changed metadata docs, not every changed doc
+            docs = {}
+            if changed:
+                rows = self.cdb.all_docs(self.user_db, keys=list(changed),
+                                         include_docs=True).json()['rows']
+                docs = {r['key']: r.get('doc') for r in rows}
+            for doc_id, kind in changed.items():
+                bare = split_id(doc_id)
+                old_name = names[kind].pop(bare, None)
+                if old_name is not None and (
+                        maps[kind].get(old_name, {}).get('_id') == bare):
+                    del maps[kind][old_name]
+                doc = docs.get(doc_id)
+                if doc and doc.get('name') is not None:
+                    maps[kind][doc['name']] = self._map_entry(kind, doc)
+                    names[kind][bare] = doc['name']
+                applied += 1
+            self.update_seq = res['last_seq']
+            if len(res['results']) < batch_size:
+                break
+        self.logger.debug('applied {0} changes to the maps'.format(applied))
+        if self.cache is not None:
+            self.cache.save(self.update_seq, maps)
+
+    def prefix_docs(self, kind):
+        """
+        Get all the documents of one type in the active budget, through a
+        range scan on their id prefix ("<BUDGET>_<kind>_")
+
+        Parameters
+        ----------
+        kind : str
+            Type of the documents (e.g. 'account', 'category', 'payee',
+            'transaction')
+
+        Returns
+        -------
+            List of the documents
+        """
+        prefix = '{0}_{1}_'.format(self.budget_selector, kind)
+        rows = self.cdb.all_docs(self.user_db,
+                                 startkey=prefix,
+                                 endkey=prefix + '\ufff0',
+                                 include_docs=True).json()['rows']
+        return [r['doc'] for r in rows if r.get('doc')]
+
     def get_all_accounts(self):
         """
         Get a list of all accounts present within the active budget
@@ -121,15 +508,13 @@ class Financier:
         -------
             List of accounts contained in the active budget
         """
-        selector = {
-            '_id': {'$regex': '^{0}_account_'.format(self.budget_selector)}}
-        return self.cdb.query(self.user_db,
-                              {'selector': selector,
-                               'fields': ['_id', 'name']}).json()['docs']
+        return [{'_id': doc['_id'], 'name': doc.get('name')}
+                for doc in self.prefix_docs('account')]
 
     def save_transaction(self, account_name,
                          category_name, value, date,
-                         payee_name, memo):
+                         payee_name, memo,
+                         idempotent=False, external_id=None):
         """
         Add a transaction to the database of the active budget.
 
@@ -151,13 +536,122 @@ class Financier:
             already exist)
         memo : str
             Memo to save in the transaction
+        idempotent : bool
+            If True, the transaction id is derived from its content (account,
+            date, value, payee and memo), so saving the same transaction
+            twice does not create a duplicate. Note that two genuinely
+            distinct transactions with identical content would then collide.
+        external_id : None or str
+            If given, the transaction id is derived from this value (e.g.
+            the bank's own transaction id) instead, which has the same
+            effect as ``idempotent`` without the risk of collisions
+
+        Returns
+        -------
+            Response of the database upon inserting the transaction, or None
+            if the transaction had already been imported (a Future of the
+            result inside :meth:`buffered`)
+        """
+        doc = self.transaction_doc(account_name, category_name, value,
+                                   date, payee_name, memo,
+                                   idempotent=idempotent,
+                                   external_id=external_id)
+        self.logger.debug('Adding {0}'.format(doc))
+        return self._save_new(doc)
+
+    def _save_new(self, doc):
+        """
+        Save a new document. A conflict means a document with the same
+        (deterministic) id has already been saved, so instead of checking
+        for it beforehand with a GET, the conflict is reported here.
+
+        Parameters
+        ----------
+        doc : dict
+            The document to save
+
+        Returns
+        -------
+            Response of the PUT request, or None if the document already
+            existed. Inside :meth:`buffered`, the document is queued instead
+            and a Future of its result is returned.
+        """
+        self.logger.debug('importing transaction {0}'.format(doc['_id']))
+        writer = self._writer
+        if writer is not None:
+            return writer.submit(doc)
+        res = self.cdb.save(self.user_db, doc)
+        if res.status_code == 409:
+            self.logger.warning(
+                'transaction {0} has already been imported '.format(
+                    doc['_id']))
+            return None
+        return res
+
+    def transaction_uuid(self, *key, external_id=None):
+        """
+        Get the (bare) uuid for a new transaction. Without arguments, this
+        is a random uuid4. Otherwise it is a uuid5 derived from the active
+        budget and either ``external_id`` or the values in ``key``, so the
+        same input always gives the same id.
+
+        Parameters
+        ----------
+        key
+            Values identifying the transaction content (e.g. account,
+            date, value, payee and memo)
+        external_id : None or str
+            Caller-supplied id for the transaction (takes precedence over
+            ``key``)
 
         Returns
         -------
-            JSON response of the database upon inserting the transaction
+            String of the uuid
         """
-        this_id = uuid.uuid4()
+        if external_id is not None:
+            name = '{0}|external|{1}'.format(self.budget_selector,
+                                             external_id)
+        elif key:
+            name = '|'.join([self.budget_selector] + [str(k) for k in key])
+        else:
+            return str(uuid.uuid4())
+        return str(uuid.uuid5(ID_NAMESPACE, name))
 
+    def transaction_doc(self, account_name,
+                        category_name, value, date,
+                        payee_name, memo,
+                        idempotent=False, external_id=None):
+        """
+        Build (without saving) the document for a transaction in the active
+        budget, resolving the account, category and payee names to ids
+        through the local maps (or the database, if not yet cached).
+
+        Parameters
+        ----------
+        account_name : str
+            Name of the account to use
+        category_name : str
+            Name of the category to use (see :meth:`save_transaction`)
+        value : float or int
+            The value of the transaction in cents
+        date : str
+            The date of the transaction (formatted YYYY-MM-DD)
+        payee_name : str
+            Name of the payee to use (will be created if it does not
+            already exist)
+        memo : str
+            Memo to save in the transaction
+        idempotent : bool
+            Derive the id from the transaction content
+            (see :meth:`save_transaction`)
+        external_id : None or str
+            Derive the id from this value (see :meth:`save_transaction`)
+
+        Returns
+        -------
+        doc : dict
+            The transaction document
+        """
         # getting account from either map or database
         account_id = self.find_account(account_name)['_id']
 
@@ -167,28 +661,201 @@ class Financier:
         # find category id from map or database:
         category_id = self.find_category(category_name)['_id']
 
-        id_transaction = self.get_id_transaction(str(this_id))
-        tr = self.get_transaction(id_transaction)
+        if idempotent or external_id is not None:
+            this_id = self.transaction_uuid(account_id, date, value,
+                                            payee_name, memo,
+                                            external_id=external_id)
+        else:
+            this_id = self.transaction_uuid()
 
-        if not tr or '_id' not in tr:
-            doc = {'_id': id_transaction, 'value': value,
-                   'account': account_id,
-                   'payee': payee_id, 'date': date,
-                   'category': category_id, 'memo': memo}
-            self.logger.debug('Adding', doc)
+        return {'_id': self.get_id_transaction(this_id),
+                'value': value,
+                'account': account_id,
+                'payee': payee_id, 'date': date,
+                'category': category_id, 'memo': memo}
 
-            if '_rev' in tr:
-                doc['_rev'] = tr['_rev']
-            self.logger.debug('importing transaction {0}'.format(doc['_id']))
+    def existing_ids(self, ids):
+        """
+        Check which of the given documents already exist in the database,
+        with a single ``_all_docs`` request
 
-            return self.cdb.save(self.user_db, doc)
-        else:
-            self.logger.warning(
-                'transaction {0} has already been imported '.format(tr['_id']))
+        Parameters
+        ----------
+        ids : list
+            Full document ids to check
+
+        Returns
+        -------
+            Set of the ids (among ``ids``) of existing, non-deleted documents
+        """
+        if not ids:
+            return set()
+        rows = self.cdb.all_docs(self.user_db, keys=list(ids)).json()['rows']
+        return {r['id'] for r in rows
+                if 'error' not in r and not r['value'].get('deleted')}
+
+    def save_transactions(self, rows, batch_size=500, max_bytes=1000000,
+                          idempotent=False):
+        """
+        Add many transactions to the database of the active budget, using
+        a handful of ``_bulk_docs`` requests instead of one request per
+        transaction. Account, category and payee names are resolved once
+        per distinct value through the local maps.
+
+        Parameters
+        ----------
+        rows : iterable
+            Dictionaries with the keys [account_name, category_name, value,
+            date, payee_name, memo] (the arguments of
+            :meth:`save_transaction`), and optionally ``external_id``;
+            consumed lazily
+        batch_size : int
+            Maximum number of transactions sent in one request
+        max_bytes : int
+            Approximate maximum size in bytes of one request body
+        idempotent : bool
+            Derive the id of each transaction from its content (see
+            :meth:`save_transaction`), so that importing the same rows twice
+            does not create duplicates
+
+        Returns
+        -------
+        results : list
+            One result dictionary per row, in the order of ``rows``. Saved
+            rows give ``{'ok': True, 'id': ..., 'rev': ...}``; failed rows
+            give ``{'id': ..., 'error': ..., 'reason': ...}`` (``id`` is None
+            if the row could not be turned into a document, e.g. because
+            its account or category does not exist). Rows that had already
+            been imported give a ``'conflict'`` error.
+        """
+        results = []
+        pending = deque()
+        deterministic = set()
+
+        def docs():
+            for row in rows:
+                try:
+                    doc = self.transaction_doc(
+                        row['account_name'],
+                        row['category_name'],
+                        row['value'],
+                        row['date'],
+                        row['payee_name'],
+                        row['memo'],
+                        idempotent=idempotent,
+                        external_id=row.get('external_id'))
+                except (KeyError, ValueError) as e:
+                    self.logger.warning('skipping row {0}: {1}'.format(
+                        row, e))
+                    results.append({'id': None, 'error': 'bad_row',
+                                    'reason': str(e)})
+                    continue
+                if idempotent or row.get('external_id') is not None:
+                    deterministic.add(doc['_id'])
+                # keep the place of this row so the bulk results can be
+                # put back in order
+                pending.append(len(results))
+                results.append(None)
+                yield doc
+
+        for batch in chunk_docs(docs(), batch_size, max_bytes):
+            # only documents with deterministic ids can already exist;
+            # check them all at once rather than one GET per row
+            to_check = [d['_id'] for d in batch if d['_id'] in deterministic]
+            deterministic.difference_update(to_check)
+            existing = self.existing_ids(to_check)
+            places = [pending.popleft() for _ in batch]
+            to_write = []
+            for place, doc in zip(places, batch):
+                if doc['_id'] in existing:
+                    results[place] = {'id': doc['_id'], 'error': 'conflict',
+                                      'reason': 'already imported'}
+                else:
+                    to_write.append((place, doc))
+            if existing:
+                self.logger.warning('{0} transactions have already been '
+                                    'imported'.format(len(existing)))
+            if not to_write:
+                continue
+
+            self.logger.debug('importing {0} transactions'.format(
+                len(to_write)))
+            res = self.cdb.bulk_docs(self.user_db, [d for _, d in to_write])
+            try:
+                res.raise_for_status()
+                batch_results = res.json()
+            except Exception as e:
+                self.logger.error('bulk import failed: {0}'.format(e))
+                batch_results = [{'id': d['_id'], 'error': 'request_failed',
+                                  'reason': str(e)} for _, d in to_write]
+            for (place, _), doc_result in zip(to_write, batch_results):
+                results[place] = doc_result
+
+        return results
+
+    def import_file(self, path, mapping, account_name, file_format=None,
+                    batch_size=500, checkpoint_file=None, progress=None,
+                    idempotent=False, date_format=None, csv_options=None):
+        """
+        Import the transactions of a CSV or OFX bank export into an account
+        of the active budget. The file is parsed lazily and written in
+        batches with :meth:`save_transactions`, so memory use stays flat
+        whatever the size of the file.
+
+        Parameters
+        ----------
+        path : str
+            Location of the file
+        mapping : dict or None
+            How to build each transaction from a parsed record: for each of
+            the fields [date, value, payee_name, memo, category_name,
+            external_id], the name of the CSV column (or OFX tag) holding it,
+            or a callable taking the record and returning it. Values read
+            from a column are converted to cents. ``category_name`` is
+            required (e.g. ``lambda r: 'To sort'``); OFX files map the
+            other fields by default.
+        account_name : str
+            Name of the account to import into
+        file_format : None or str
+            ``'csv'`` or ``'ofx'``; by default, guessed from the extension
+        batch_size : int
+            Number of transactions written per request
+        checkpoint_file : None or str
+            If given, the number of rows saved so far is kept in this file,
+            and an interrupted import of the same file resumes after them.
+            The file is removed once the import is complete.
+        progress : None or callable
+            Called with an :class:`~pythonfinancier.importer.ImportProgress`
+            after each batch
+        idempotent : bool
+            Derive transaction ids from their content (see
+            :meth:`save_transaction`); OFX transactions use their ``FITID``
+            as ``external_id`` anyway
+        date_format : None or str
+            :func:`~datetime.datetime.strptime` format of the dates, if they
+            are not YYYY-MM-DD
+        csv_options : None or dict
+            Options of :class:`csv.DictReader` (e.g. ``delimiter``)
+
+        Returns
+        -------
+            Final :class:`~pythonfinancier.importer.ImportProgress`
+        """
+        from pythonfinancier.importer import import_file
+
+        return import_file(self, path, mapping, account_name,
+                           file_format=file_format,
+                           batch_size=batch_size,
+                           checkpoint_file=checkpoint_file,
+                           progress=progress,
+                           idempotent=idempotent,
+                           date_format=date_format,
+                           csv_options=csv_options)
 
     def save_split(self, account_name,
                    value, date, payee_name,
-                   memo, transactions):
+                   memo, transactions,
+                   idempotent=False, external_id=None):
         """
         Add a split transaction to the database.
 
@@ -209,21 +876,31 @@ class Financier:
         transactions : list
             a list of dictionaries, each with keys [value, category_name,
             memo, payee_name], which will be included in the split transaction
+        idempotent : bool
+            Derive the transaction id from its content (see
+            :meth:`save_transaction`)
+        external_id : None or str
+            Derive the transaction id from this value (see
+            :meth:`save_transaction`)
 
         Returns
         -------
-            JSON response of the database upon inserting the transaction
+            Response of the database upon inserting the transaction, or None
+            if the transaction had already been imported (a Future of the
+            result inside :meth:`buffered`)
         """
-        this_id = uuid.uuid4()
-
         # getting account from either map or database
         account_id = self.find_account(account_name)['_id']
 
         # getting payee or creating a new one
         payee_id = self.get_or_create_payee(payee_name)['_id']
 
-        id_transaction = self.get_id_transaction(str(this_id))
-        tr = self.get_transaction(id_transaction)
+        if idempotent or external_id is not None:
+            this_id = self.transaction_uuid(account_id, date, value,
+                                            payee_name, memo,
+                                            external_id=external_id)
+        else:
+            this_id = self.transaction_uuid()
 
         self.logger.info(transactions)
         for i, t in enumerate(transactions):
@@ -233,23 +910,14 @@ class Financier:
 
         self.logger.info(transactions)
 
-        if not tr or '_id' not in tr:
-            # category is "split"
-            doc = {'_id': id_transaction, 'value': value,
-                   'account': account_id,
-                   'payee': payee_id, 'date': date,
-                   'category': 'split', 'memo': memo,
-                   'splits': transactions}
-            self.logger.debug('Adding', doc)
-
-            if '_rev' in tr:
-                doc['_rev'] = tr['_rev']
-            self.logger.debug('importing transaction {0}'.format(doc['_id']))
-
-            return self.cdb.save(self.user_db, doc)
-        else:
-            self.logger.warning(
-                'transaction {0} has already been imported '.format(tr['_id']))
+        # category is "split"
+        doc = {'_id': self.get_id_transaction(this_id), 'value': value,
+               'account': account_id,
+               'payee': payee_id, 'date': date,
+               'category': 'split', 'memo': memo,
+               'splits': transactions}
+        self.logger.debug('Adding {0}'.format(doc))
+        return self._save_new(doc)
 
     def save_transfer(self,
                       from_account_name,
@@ -257,7 +925,9 @@ class Financier:
                       value,
                       date,
                       memo=None,
-                      from_category_name=None):
+                      from_category_name=None,
+                      idempotent=False,
+                      external_id=None):
         """
         Add a split transaction to the database.
 
@@ -278,14 +948,19 @@ class Financier:
         from_category_name : str or None
             If the transfer is to an off-budget account, the category should
             be provided (optional)
+        idempotent : bool
+            Derive the ids of both transactions from the transfer content
+            (see :meth:`save_transaction`)
+        external_id : None or str
+            Derive the ids of both transactions from this value (see
+            :meth:`save_transaction`)
 
         Returns
         -------
-            JSON response of the database upon inserting the transaction
+            Responses of the database upon inserting both transactions (each
+            one is None if that transaction had already been imported, or
+            Futures of the results inside :meth:`buffered`)
         """
-        from_id = uuid.uuid4()
-        to_id = uuid.uuid4()
-
         # getting account from either map or database
         from_account_id = self.find_account(from_account_name)['_id']
         to_account_id = self.find_account(to_account_name)['_id']
@@ -296,56 +971,45 @@ class Financier:
         else:
             from_category_id = None
 
+        if external_id is not None:
+            from_id = self.transaction_uuid(
+                external_id=str(external_id) + '|from')
+            to_id = self.transaction_uuid(external_id=str(external_id) + '|to')
+        elif idempotent:
+            key = (from_account_id, to_account_id, date, value, memo)
+            from_id = self.transaction_uuid(*key, 'from')
+            to_id = self.transaction_uuid(*key, 'to')
+        else:
+            from_id = self.transaction_uuid()
+            to_id = self.transaction_uuid()
+
         # Need to create two transactions for each side of the transfer
         # 'payee' is null; 'account' is the bare uuid of this account
         # 'transfer' is the bare uuid of the corresponding transaction in
         # the other account; 'category' is null (if the transfer is on-budget
 
-        from_id_transaction = self.get_id_transaction(str(from_id))
-        to_id_transaction = self.get_id_transaction(str(to_id))
-        from_tr = self.get_transaction(from_id_transaction)
-        to_tr = self.get_transaction(to_id_transaction)
-
         # setup from transaction:
-        if not from_tr or '_id' not in from_tr:
-            from_doc = {'_id': from_id_transaction,
-                        'value': -1 * value,
-                        'account': from_account_id,
-                        'date': date,
-                        'memo': memo,
-                        'category': from_category_id,
-                        'transfer': str(to_id)
-                        }
-            if '_rev' in from_tr:
-                from_doc['_rev'] = from_tr['_rev']
-
-            self.logger.debug('Adding from_doc', from_doc)
-            from_save_output = self.cdb.save(self.user_db, from_doc)
-        else:
-            self.logger.warning(
-                'from_transaction {0} has already been '
-                'imported '.format(from_tr['_id']))
-            from_save_output = None
+        from_doc = {'_id': self.get_id_transaction(from_id),
+                    'value': -1 * value,
+                    'account': from_account_id,
+                    'date': date,
+                    'memo': memo,
+                    'category': from_category_id,
+                    'transfer': to_id
+                    }
+        self.logger.debug('Adding from_doc {0}'.format(from_doc))
+        from_save_output = self._save_new(from_doc)
 
         # setup to transaction:
-        if not to_tr or '_id' not in to_tr:
-            to_doc = {'_id': to_id_transaction,
-                      'value': value,
-                      'account': to_account_id,
-                      'date': date,
-                      'memo': memo,
-                      'transfer': str(from_id)
-                      }
-            if '_rev' in to_tr:
-                to_doc['_rev'] = to_tr['_rev']
-
-            self.logger.debug('Adding to_doc', to_doc)
-            to_save_output = self.cdb.save(self.user_db, to_doc)
-        else:
-            self.logger.warning(
-                'to_transaction {0} has already been '
-                'imported '.format(to_tr['_id']))
-            to_save_output = None
+        to_doc = {'_id': self.get_id_transaction(to_id),
+                  'value': value,
+                  'account': to_account_id,
+                  'date': date,
+                  'memo': memo,
+                  'transfer': from_id
+                  }
+        self.logger.debug('Adding to_doc {0}'.format(to_doc))
+        to_save_output = self._save_new(to_doc)
 
         return from_save_output, to_save_output
 
@@ -365,6 +1029,100 @@ class Financier:
         """
         return self.cdb.get_doc(self.user_db, id_transaction).json()
 
+    def get_transactions(self, ids, batch_size=500):
+        """
+        Get several transactions, with one ``_bulk_get`` request per batch
+        of ids (or ``_all_docs`` requests, on servers without ``_bulk_get``)
+
+        Parameters
+        ----------
+        ids : iterable
+            Full transaction ids
+        batch_size : int
+            Maximum number of ids per request
+
+        Returns
+        -------
+            List of the transaction documents, in the order of ``ids`` (None
+            for missing or deleted transactions)
+        """
+        ids = list(ids)
+        docs = []
+        for start in range(0, len(ids), batch_size):
+            docs.extend(self._get_docs(ids[start:start + batch_size]))
+        return docs
+
+    def _get_docs(self, ids):
+        res = self.cdb.bulk_get(self.user_db, ids)
+        if res.status_code in (400, 404, 405):
+            # no _bulk_get (CouchDB 1.x)
+            rows = self.cdb.all_docs(self.user_db, keys=ids,
+                                     include_docs=True).json()['rows']
+            return [r.get('doc') for r in rows]
+        res.raise_for_status()
+        return [r['docs'][0].get('ok') for r in res.json()['results']]
+
+    def update_transactions(self, ids, changes, batch_size=500,
+                            max_attempts=3):
+        """
+        Edit several existing transactions (e.g. to re-categorize them):
+        the transactions are fetched in bulk, changed, and written back in
+        bulk. Transactions modified concurrently (conflicts) are fetched
+        and changed again, together, in a following round.
+
+        Parameters
+        ----------
+        ids : iterable
+            Full transaction ids
+        changes : dict or callable
+            Fields to set in each transaction (e.g.
+            ``{'category': category_id}``), or a function changing the
+            given transaction document in place (or returning the changed
+            document)
+        batch_size : int
+            Maximum number of documents per request
+        max_attempts : int
+            Number of rounds after which transactions still in conflict are
+            given up
+
+        Returns
+        -------
+            List of the results, in the order of ``ids``: ``{'ok', 'id',
+            'rev'}`` for updated transactions, or ``{'id', 'error',
+            'reason'}`` (``not_found`` for missing transactions)
+        """
+        ids = list(ids)
+        results = {}
+        todo = ids
+        for attempt in range(max_attempts):
+            if not todo:
+                break
+            retry = []
+            for start in range(0, len(todo), batch_size):
+                batch = todo[start:start + batch_size]
+                docs = []
+                for _id, doc in zip(batch, self._get_docs(batch)):
+                    if doc is None:
+                        results[_id] = {'id': _id, 'error': 'not_found',
+                                        'reason': 'missing'}
+                    elif callable(changes):
+                        docs.append(changes(doc) or doc)
+                    else:
+                        doc.update(changes)
+                        docs.append(doc)
+                if not docs:
+                    continue
+                res = self.cdb.bulk_docs(self.user_db, docs)
+                res.raise_for_status()
+                for doc, result in zip(docs, res.json()):
+                    results[doc['_id']] = result
+                    if result.get('error') == 'conflict':
+                        retry.append(doc['_id'])
+            self.logger.info('updated {0} transactions: {1} conflicts'.format(
+                len(todo), len(retry)))
+            todo = retry
+        return [results[_id] for _id in ids]
+
     def get_id_transaction(self, this_id):
         """
         Helper function to build a valid transaction id from the currently
@@ -395,7 +1153,7 @@ class Financier:
             List of account json objects that match the given name
         """
         return self.cdb.query(self.user_db, {
-            'selector': {'_id': {'$regex': '^budget_'}, 'name': name},
+            'selector': {'_id': id_range('budget_'), 'name': name},
             'fields': ['_id', 'name']}).json()['docs']
 
     def find_account(self, name):
@@ -412,15 +1170,15 @@ class Financier:
         res : dict
             The doc dictionary of the account
         """
-        if name in self.account_map:
+        res = self.account_map.get(name)
+        self._record_lookup('account', name, res is not None)
+        if res is not None:
             self.logger.info('got account ({}) '
                              'from self.account_map'.format(name))
-            res = self.account_map[name]
 
         else:
             selector = {
-                '_id': {'$regex':
-                        '^{0}_account_'.format(self.budget_selector)},
+                '_id': id_range('{0}_account_'.format(self.budget_selector)),
                 'name': name}
 
             try:
@@ -443,9 +1201,10 @@ class Financier:
     def find_transaction(self,
                          memo=None,
                          value=None,
-                         date=None):
+                         date=None,
+                         **filters):
         """
-        Find transaction(s) by memo or value within the database
+        Find transaction(s) within the active budget
 
         Parameters
         ----------
@@ -455,23 +1214,325 @@ class Financier:
             Value for which to search in cents (must be exact match)
         date : str
             Date for which to search (YYYY-MM-DD)
+        filters
+            Other filters of :meth:`transaction_selector` (date and value
+            ranges, account, payee or category name)
 
         Returns
         -------
-            List of transaction json objects that match the given name
+            List of transaction json objects that match the given filters
         """
-        selector = {
-            '_id': {'$regex': '^{0}_transaction_'.format(
-                self.budget_selector)}}
-        if memo:
+        selector = self.transaction_selector(memo=memo, value=value,
+                                             date=date, **filters)
+        if selector is None:
+            return []
+        return list(self.iter_transactions(selector))
+
+    def transaction_selector(self,
+                             memo=None,
+                             value=None,
+                             date=None,
+                             date_from=None,
+                             date_to=None,
+                             value_min=None,
+                             value_max=None,
+                             account_name=None,
+                             payee_name=None,
+                             category_name=None):
+        """
+        Build the Mango selector of a transaction search. Every filter is
+        optional (None means "not given", so a ``value`` of 0 is a valid
+        filter). Date ranges, alone or with an account, payee or category,
+        are served by the indexes created by :meth:`ensure_indexes`.
+
+        Parameters
+        ----------
+        memo : str
+            Memo for which to search (must be an exact match)
+        value : float or int
+            Value in cents (must be an exact match)
+        date : str
+            Date of the transaction (YYYY-MM-DD)
+        date_from : str
+            First date (included) of the transactions
+        date_to : str
+            Last date (included) of the transactions
+        value_min : float or int
+            Smallest value (included) in cents
+        value_max : float or int
+            Largest value (included) in cents
+        account_name : str
+            Name of the account of the transactions
+        payee_name : str
+            Name of the payee of the transactions
+        category_name : str
+            Name of the category of the transactions (split transactions
+            with a split in this category also match)
+
+        Returns
+        -------
+            The selector (to use with :meth:`iter_transactions`), or None if
+            the given payee does not exist, so nothing can match
+        """
+        selector = {}
+        if memo is not None:
             selector['memo'] = memo
-        if value:
+        if value is not None:
             selector['value'] = value
-        if date:
+        if date is not None:
             selector['date'] = date
 
-        return self.cdb.query(self.user_db,
-                              {'selector': selector}).json()['docs']
+        date_range = {}
+        if date_from is not None:
+            date_range['$gte'] = date_from
+        if date_to is not None:
+            date_range['$lte'] = date_to
+        if date_range and date is None:
+            selector['date'] = date_range
+
+        value_range = {}
+        if value_min is not None:
+            value_range['$gte'] = value_min
+        if value_max is not None:
+            value_range['$lte'] = value_max
+        if value_range and value is None:
+            selector['value'] = value_range
+
+        if account_name is not None:
+            selector['account'] = self.find_account(account_name)['_id']
+        if payee_name is not None:
+            payee = self.payee_map.get(payee_name)
+            self._record_lookup('payee', payee_name, payee is not None)
+            if payee is not None:
+                selector['payee'] = payee['_id']
+            else:
+                payee = self.find_payee(payee_name)
+                if not payee:
+                    return None
+                selector['payee'] = split_id(payee[0]['_id'])
+        if category_name is not None:
+            category_id = self.find_category(category_name)['_id']
+            selector['$or'] = [
+                {'category': category_id},
+                {'splits': {'$elemMatch': {'category': category_id}}}]
+        return selector
+
+    def iter_transactions(self, selector=None, page_size=200, fields=None,
+                          limit=None):
+        """
+        Iterate over the transactions of the active budget matching a
+        selector. Results are fetched lazily, one page at a time, so large
+        searches neither stop at the first page nor build one big list.
+
+        Parameters
+        ----------
+        selector : None or dict
+            Mango selector the transactions must match (in addition to
+            belonging to the active budget)
+        page_size : int
+            Number of transactions fetched per request
+        fields : None or list
+            If given, only these fields of each transaction are fetched
+        limit : None or int
+            Maximum number of transactions to yield
+
+        Returns
+        -------
+            Generator of transaction json objects
+        """
+        selector = dict(selector or {})
+        selector['_id'] = id_range('{0}_transaction_'.format(
+            self.budget_selector))
+        query = {'selector': selector}
+        if fields is not None:
+            query['fields'] = fields
+        if limit is not None:
+            page_size = min(page_size, limit)
+        for i, doc in enumerate(self.cdb.iter_query(self.user_db, query,
+                                                    page_size)):
+            if limit is not None and i >= limit:
+                return
+            yield doc
+
+    def transactions_frame(self, kind='pandas', page_size=1000, **filters):
+        """
+        Export transactions of the active budget into a columnar frame for
+        analytics (requires numpy, plus pandas or pyarrow for those kinds).
+        Transactions are streamed page by page into int64 ``value`` (cents),
+        datetime64 ``date`` and categorical ``account``, ``payee`` and
+        ``category`` columns, whose names come from the local maps.
+
+        Parameters
+        ----------
+        kind : str
+            ``'pandas'`` (DataFrame), ``'arrow'`` (pyarrow Table) or
+            ``'numpy'`` (tuple of a structured array and a dict of the
+            labels of each coded column)
+        page_size : int
+            Number of transactions fetched per request
+        filters
+            Filters of :meth:`transaction_selector`
+
+        Returns
+        -------
+            The frame of the matching transactions
+        """
+        from pythonfinancier import frames
+
+        selector = self.transaction_selector(**filters)
+        if selector is None:
+            docs = iter(())
+        else:
+            docs = self.iter_transactions(selector, page_size=page_size,
+                                          fields=frames.FIELDS)
+        maps = {'account': self.account_map,
+                'payee': self.payee_map,
+                'category': self.category_map}
+        refreshed = []
+
+        def names(column, ids):
+            by_id = {e['_id']: n for n, e in maps[column].items()}
+            if not refreshed and any(
+                    i not in by_id and i not in SPECIAL_CATEGORIES
+                    for i in ids):
+                # some names are not cached yet: load them all at once
+                refreshed.append(True)
+                self.refresh_maps()
+                by_id = {e['_id']: n for n, e in maps[column].items()}
+            return [by_id.get(i, i) for i in ids]
+
+        return frames.build_frame(docs, names, kind)
+
+    def install_views(self):
+        """
+        Install (or update) the design document of the map/reduce views
+        used by :meth:`account_balances` and :meth:`category_totals` (see
+        :mod:`pythonfinancier.views`). The server builds the views on their
+        first query, which can take a while for large databases.
+
+        Returns
+        -------
+            Response of the PUT request, or None if the views were already
+            up to date
+        """
+        doc = views.design_doc()
+        current = self.cdb.get_doc(self.user_db, doc['_id'])
+        if current.status_code == 200:
+            current = current.json()
+            if current.get('views') == doc['views']:
+                return None
+            doc['_rev'] = current['_rev']
+        self.logger.info('installing views {0}'.format(doc['_id']))
+        res = self.cdb.save(self.user_db, doc)
+        res.raise_for_status()
+        return res
+
+    def _view_rows(self, view, group_level):
+        """
+        Rows of a view for the active budget, grouped at ``group_level``
+        """
+        return self.cdb.view(self.user_db, views.DDOC, view,
+                             group_level=group_level,
+                             **views.key_range(self.budget_selector)
+                             ).json()['rows']
+
+    def _id_names(self, kind, ids):
+        """
+        Map ids of accounts or categories to their names, loading the maps
+        (once) if some are unknown. Unknown ids are mapped to themselves.
+        """
+        name_map = self._maps()[kind]
+        by_id = {e['_id']: n for n, e in name_map.items()}
+        if any(i not in by_id and i not in SPECIAL_CATEGORIES for i in ids):
+            self.refresh_maps()
+            by_id = {e['_id']: n for n, e in name_map.items()}
+        return {i: by_id.get(i, i) for i in ids}
+
+    def account_balances(self):
+        """
+        Get the balance of every account of the active budget, summed by
+        the server (see :meth:`install_views`)
+
+        Returns
+        -------
+            Dictionary of the balance (in cents) of each account, by name
+        """
+        rows = self._view_rows('account_month', 2)
+        names = self._id_names('account', [r['key'][1] for r in rows])
+        return {names[r['key'][1]]: r['value'] for r in rows}
+
+    def category_totals(self, month_range=None):
+        """
+        Get the total of the transactions of each category of the active
+        budget, per month, summed by the server (see :meth:`install_views`)
+
+        Parameters
+        ----------
+        month_range : None or tuple
+            ``(first, last)`` months (YYYY-MM, inclusive) to include; all
+            months if None
+
+        Returns
+        -------
+            Dictionary, by category name, of the total (in cents) of each
+            month (by YYYY-MM)
+        """
+        rows = self._view_rows('category_month', 3)
+        if month_range is not None:
+            first, last = month_range
+            rows = [r for r in rows if first <= r['key'][2] <= last]
+        names = self._id_names('category', [r['key'][1] for r in rows])
+        totals = {}
+        for r in rows:
+            month_totals = totals.setdefault(names[r['key'][1]], {})
+            month = r['key'][2]
+            month_totals[month] = month_totals.get(month, 0) + r['value']
+        return totals
+
+    def reconcile(self, statement_rows, account_name, date_tolerance_days=3):
+        """
+        Find which rows of a bank statement already exist in an account.
+        The transactions of the account over the statement's date window
+        (widened by the tolerance) are fetched with a single paginated
+        search, then matched on value and date proximity locally.
+
+        Parameters
+        ----------
+        statement_rows : list
+            Dictionaries with (at least) ``value`` (in cents) and ``date``
+            (YYYY-MM-DD); rows with all the keys of
+            :meth:`save_transactions` can be imported directly once
+            reconciled
+        account_name : str
+            Name of the account the statement belongs to
+        date_tolerance_days : int
+            Maximum difference in days between a row and the transaction
+            it matches
+
+        Returns
+        -------
+            Dictionary with the ``'matched'`` rows (list of
+            ``(row, transaction)``), the ``'missing'`` rows (to import) and
+            the ``'ambiguous'`` rows (list of ``(row, transactions)``); see
+            :func:`pythonfinancier.reconcile.match_rows`
+        """
+        from pythonfinancier.reconcile import match_rows, day_number
+
+        statement_rows = list(statement_rows)
+        if not statement_rows:
+            return {'matched': [], 'missing': [], 'ambiguous': []}
+        days = [day_number(r['date']) for r in statement_rows]
+        tolerance = datetime.timedelta(days=date_tolerance_days)
+        date_from = datetime.date.fromordinal(min(days)) - tolerance
+        date_to = datetime.date.fromordinal(max(days)) + tolerance
+        selector = self.transaction_selector(
+            account_name=account_name,
+            date_from=date_from.isoformat(),
+            date_to=date_to.isoformat())
+        docs = self.iter_transactions(
+            selector, page_size=1000,
+            fields=['_id', 'date', 'value', 'payee', 'category', 'memo'])
+        return match_rows(statement_rows, docs, date_tolerance_days)
 
     def find_payee(self, name):
         """
@@ -486,7 +1547,7 @@ class Financier:
             List of payee json objects that match the given name
         """
         selector = {
-            '_id': {'$regex': '^{0}_payee_'.format(self.budget_selector)},
+            '_id': id_range('{0}_payee_'.format(self.budget_selector)),
             'name': name}
         return self.cdb.query(self.user_db,
                               {'selector': selector,
@@ -508,20 +1569,23 @@ class Financier:
             Doc dictionary of the category with bare ``_id`` (without budget
             id) and ``name``
         """
+        cached = self.category_map.get(name)
         if name in ['income', 'incomeNextMonth']:
             self.logger.debug('*** got category ({})'.format(name))
             res = {'_id': name,
                    'name': name}
 
-        elif name in self.category_map:
+        elif cached is not None:
+            self._record_lookup('category', name, True)
             self.logger.debug('*** got category ({}) '
                               'from self.category_map'.format(name))
-            res = self.category_map[name]
+            res = cached
 
         else:
+            self._record_lookup('category', name, False)
             selector = {
-                '_id': {'$regex':
-                        '^{0}_category_'.format(self.budget_selector)},
+                '_id': id_range('{0}_category_'.format(
+                    self.budget_selector)),
                 'name': name}
             try:
                 # result of query is a list of dicts:
@@ -557,7 +1621,33 @@ class Financier:
             'name': name, 'internal': False, 'autosuggest': True}
         return self.cdb.insert(self.user_db, doc).json()
 
-    def get_or_create_payee(self, name):
+    def payee_index(self, refresh=False):
+        """
+        Get the index of the payees of the active budget (normalized names,
+        with prefix and similarity lookups), loading every payee with one
+        range scan the first time
+
+        Parameters
+        ----------
+        refresh : bool
+            Load the payees again
+
+        Returns
+        -------
+            :class:`~pythonfinancier.payeeindex.PayeeIndex` of the payee map
+            entries
+        """
+        with self._payee_index_lock:
+            if self._payee_index is None or refresh:
+                self._payee_index = PayeeIndex(
+                    self._map_entry('payee', doc)
+                    for doc in self.prefix_docs('payee')
+                    if doc.get('name') is not None)
+                self.logger.debug('indexed {0} payees'.format(
+                    len(self._payee_index)))
+            return self._payee_index
+
+    def get_or_create_payee(self, name, fuzzy=None):
         """
         Return id of a payee, and create one if it does not exist, adding it
         to the payee_map cache for later use
@@ -566,6 +1656,9 @@ class Financier:
         ----------
         name : str
             Name of the payee to use or get
+        fuzzy : None or bool
+            Whether an existing payee with a similar name (see
+            :meth:`PayeeIndex.match`) is used; ``fuzzy_payees`` if None
 
         Returns
         -------
@@ -573,23 +1666,56 @@ class Financier:
             The doc dictionary of the existing (or created) payee
         """
         # first check the cache map
-        if name in self.payee_map:
+        payee = self.payee_map.get(name)
+        self._record_lookup('payee', name, payee is not None)
+        if payee is not None:
             self.logger.info('Got payee ({}) from payee_map'.format(name))
-            return self.payee_map[name]
-
-        else:
-            payee = self.find_payee(name)
-            if payee:
-                payee = payee[0]
-                payee['_id'] = split_id(payee['_id'])
-                self.logger.info('found payee ({}) in remote database'.format(
-                    name))
-                self.payee_map[name] = payee  # add to payee_map
-                return payee
+            return payee
+
+        # only one thread looks up (and creates) a given payee; the others
+        # wait for its result instead of creating duplicates
+        with self._payee_lock:
+            pending = self._pending_payees.get(name)
+            if pending is None:
+                payee = self.payee_map.get(name)
+                if payee is not None:
+                    return payee
+                future = self._pending_payees[name] = Future()
+        if pending is not None:
+            return pending.result()
+        try:
+            if fuzzy is None:
+                fuzzy = self.fuzzy_payees
+            payee = self.payee_index().match(name) if fuzzy else None
+            if payee is not None:
+                self.logger.info('matched payee ({0}) to {1}'.format(
+                    name, payee['name']))
             else:
-                payee = self.insert_payee(name)
-                payee['_id'] = split_id(payee['id'])
-                self.logger.info('added payee ({}) to remote database'.format(
-                    name))
-                self.payee_map[name] = payee  # add to payee_map
-                return payee
+                payee = self._find_or_insert_payee(name)
+            self.payee_map[name] = payee  # add to payee_map
+            future.set_result(payee)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._payee_lock:
+                del self._pending_payees[name]
+        return payee
+
+    def _find_or_insert_payee(self, name):
+        payee = self.find_payee(name)
+        if payee:
+            payee = payee[0]
+            payee['_id'] = split_id(payee['_id'])
+            self.logger.info('found payee ({}) in remote database'.format(
+                name))
+        else:
+            payee = self.insert_payee(name)
+            payee['_id'] = split_id(payee['id'])
+            self.logger.info('added payee ({}) to remote database'.format(
+                name))
+        if self._payee_index is not None:
+            self._payee_index.add({'_id': payee['_id'], 'name': name,
+                                   'categorySuggest': payee.get(
+                                       'categorySuggest')})
+        return payee
@@ -0,0 +1,176 @@
+"""
+Columnar export of transactions for analytics. Transactions are streamed
+page by page into compact arrays (int64 cents, datetime64 dates and integer
+codes for the account, payee and category ids), then returned as a NumPy
+structured array, a pandas DataFrame or an Arrow table. Requires the
+optional ``numpy`` package (and ``pandas`` or ``pyarrow`` for those
+outputs).
+"""
+
+from array import array
+import logging
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# fields fetched for each transaction
+FIELDS = ['date', 'value', 'account', 'payee', 'category']
+# columns holding ids, stored as codes into a list of labels
+CODED = ['account', 'payee', 'category']
+# number of dates converted to datetime64 at once
+DATE_CHUNK = 10000
+
+
+class Codes:
+    """
+    Assigns consecutive integer codes to the distinct ids of a column
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.ids = []
+
+    def code(self, _id):
+        if _id is None:
+            return -1
+        code = self.codes.get(_id)
+        if code is None:
+            code = self.codes[_id] = len(self.ids)
+            self.ids.append(_id)
+        return code
+
+
+def collect(docs):
+    """
+    Read transactions into columnar arrays
+
+    Parameters
+    ----------
+    docs : iterable
+        Transaction json objects (with at least the ``FIELDS``); consumed
+        lazily, so only the arrays are kept in memory
+
+    Returns
+    -------
+        Tuple ``(columns, ids)``: ``columns`` maps each column name to a
+        NumPy array and ``ids`` maps each coded column to the list of ids
+        (indexed by code)
+    """
+    values = array('q')
+    codes = {c: array('i') for c in CODED}
+    coders = {c: Codes() for c in CODED}
+    date_chunks = []
+    dates = []
+    for doc in docs:
+        values.append(int(round(doc.get('value') or 0)))
+        dates.append(doc.get('date') or 'NaT')
+        for c in CODED:
+            codes[c].append(coders[c].code(doc.get(c)))
+        if len(dates) >= DATE_CHUNK:
+            date_chunks.append(np.array(dates, dtype='datetime64[D]'))
+            dates = []
+    date_chunks.append(np.array(dates, dtype='datetime64[D]'))
+
+    columns = {'value': np.frombuffer(values, dtype=np.int64)
+               if len(values) else np.zeros(0, dtype=np.int64),
+               'date': np.concatenate(date_chunks)}
+    for c in CODED:
+        columns[c] = np.frombuffer(codes[c], dtype=np.int32) \
+            if len(codes[c]) else np.zeros(0, dtype=np.int32)
+    return columns, {c: coders[c].ids for c in CODED}
+
+
+def unique_labels(names, ids):
+    """
+    Make a list of labels unique (so it can be used as categories), by
+    adding the id to the names that appear more than once
+    """
+    seen = {}
+    for name in names:
+        seen[name] = seen.get(name, 0) + 1
+    return [name if seen[name] == 1 else '{0} ({1})'.format(name, _id)
+            for name, _id in zip(names, ids)]
+
+
+def to_numpy(columns, labels):
+    """
+    Build a NumPy structured array (one record per transaction)
+
+    Returns
+    -------
+        Tuple ``(records, labels)``, ``labels`` giving the name of each code
+        of the ``account``, ``payee`` and ``category`` fields
+    """
+    dtype = [('value', np.int64), ('date', 'datetime64[D]')] + \
+        [(c, np.int32) for c in CODED]
+    records = np.empty(len(columns['value']), dtype=dtype)
+    for name in records.dtype.names:
+        records[name] = columns[name]
+    return records, labels
+
+
+def to_pandas(columns, labels):
+    """
+    Build a pandas DataFrame, with categorical ``account``, ``payee`` and
+    ``category`` columns
+    """
+    import pandas as pd
+
+    data = {'value': columns['value'], 'date': columns['date']}
+    for c in CODED:
+        data[c] = pd.Categorical.from_codes(columns[c], categories=labels[c])
+    return pd.DataFrame(data)
+
+
+def to_arrow(columns, labels):
+    """
+    Build an Arrow table, with dictionary-encoded ``account``, ``payee``
+    and ``category`` columns
+    """
+    import pyarrow as pa
+
+    data = {'value': pa.array(columns['value']),
+            'date': pa.array(columns['date'])}
+    for c in CODED:
+        codes = columns[c]
+        data[c] = pa.DictionaryArray.from_arrays(
+            pa.array(codes, mask=codes < 0), pa.array(labels[c],
+                                                      type=pa.string()))
+    return pa.table(data)
+
+
+BUILDERS = {'numpy': to_numpy, 'pandas': to_pandas, 'arrow': to_arrow}
+
+
+def build_frame(docs, names, kind='pandas'):
+    """
+    Build a columnar frame of transactions
+
+    Parameters
+    ----------
+    docs : iterable
+        Transaction json objects
+    names : callable
+        ``names(column, ids)`` returns the names of the given ids of a
+        coded column
+    kind : str
+        ``'numpy'``, ``'pandas'`` or ``'arrow'``
+
+    Returns
+    -------
+        The frame (see :func:`to_numpy`, :func:`to_pandas` and
+        :func:`to_arrow`)
+    """
+    if np is None:
+        raise ImportError('transactions_frame requires the numpy package')
+    if kind not in BUILDERS:
+        raise ValueError('kind must be one of {0}'.format(sorted(BUILDERS)))
+    columns, ids = collect(docs)
+    labels = {c: unique_labels(names(c, ids[c]), ids[c]) for c in CODED}
+    logger.debug('built {0} frame of {1} transactions'.format(
+        kind, len(columns['value'])))
+    return BUILDERS[kind](columns, labels)
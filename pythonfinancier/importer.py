@@ -0,0 +1,258 @@
+"""
+Streaming import of bank exports (CSV or OFX files) into a budget. Rows are
+parsed lazily and written in batches through ``_bulk_docs``; the next batch
+is only read once the previous one is saved, so memory use does not depend
+on the size of the file. Progress is recorded in an optional checkpoint
+file, so an interrupted import resumes after the last saved batch.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+import csv
+import json
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+ImportProgress = namedtuple('ImportProgress', [
+    'rows', 'saved', 'skipped', 'failed', 'batches', 'elapsed',
+    'rows_per_second'])
+ImportProgress.__doc__ = """
+Progress of an import: number of rows processed (including the rows
+passed over when resuming), saved, skipped (already imported) and failed,
+number of batches written, elapsed seconds and throughput (rows processed
+per second in this run)
+"""
+
+def to_cents(amount):
+    """
+    Convert an amount of money written as text (e.g. "-1,234.56") into an
+    integer number of cents
+
+    Parameters
+    ----------
+    amount : str
+        The amount; "," is taken as the decimal separator if there is no
+        "."
+
+    Returns
+    -------
+        Integer value in cents
+    """
+    text = amount.strip().replace(' ', '')
+    if '.' in text:
+        text = text.replace(',', '')
+    else:
+        text = text.replace(',', '.')
+    return int((Decimal(text) * 100).to_integral_value())
+
+
+def ofx_date(value):
+    """
+    Convert an OFX date (YYYYMMDD[HHMMSS...]) into YYYY-MM-DD
+    """
+    value = value.strip()
+    return '{0}-{1}-{2}'.format(value[0:4], value[4:6], value[6:8])
+
+
+# mapping used for OFX files (category_name must still be provided)
+OFX_MAPPING = {'date': lambda r: ofx_date(r['DTPOSTED']),
+               'value': lambda r: to_cents(r['TRNAMT']),
+               'payee_name': lambda r: r.get('NAME') or r.get('PAYEE', ''),
+               'memo': lambda r: r.get('MEMO', ''),
+               'external_id': 'FITID'}
+
+_OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+def read_csv(path, **csv_options):
+    """
+    Lazily read the records of a CSV file (with a header line)
+
+    Parameters
+    ----------
+    path : str
+        Location of the file
+    csv_options
+        Passed on to :class:`csv.DictReader` (e.g. ``delimiter``)
+
+    Returns
+    -------
+        Generator of dictionaries (column name -> text)
+    """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        yield from csv.DictReader(f, **csv_options)
+
+
+def read_ofx(path, chunk_size=65536):
+    """
+    Lazily read the transactions (``STMTTRN``) of an OFX file, in either
+    its SGML (unclosed leaf tags) or XML form
+
+    Parameters
+    ----------
+    path : str
+        Location of the file
+    chunk_size : int
+        Number of characters read at once
+
+    Returns
+    -------
+        Generator of dictionaries (tag name -> text) of each transaction
+    """
+    record = None
+    rest = ''
+    with open(path, encoding='utf-8', errors='replace') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            data = rest + chunk
+            # keep the (possibly incomplete) last tag for the next chunk
+            cut = data.rfind('<') if chunk else len(data)
+            if cut < 0:
+                cut = len(data)
+            for closing, tag, text in _OFX_TAG.findall(data[:cut]):
+                tag = tag.upper()
+                if tag == 'STMTTRN':
+                    if closing and record is not None:
+                        yield record
+                        record = None
+                    elif not closing:
+                        record = {}
+                elif record is not None and not closing:
+                    record[tag] = text.strip()
+            rest = data[cut:]
+            if not chunk:
+                break
+
+
+def map_record(record, mapping):
+    """
+    Build a row (as given to :meth:`Financier.save_transactions`) from a
+    parsed record
+
+    Parameters
+    ----------
+    record : dict
+        Parsed CSV or OFX record
+    mapping : dict
+        For each field of the row, the name of the record's column or a
+        callable computing it from the record. ``value`` columns are
+        converted to cents with :func:`to_cents`.
+
+    Returns
+    -------
+        The row dictionary (without ``account_name``)
+    """
+    row = {'memo': '', 'payee_name': ''}
+    for field, source in mapping.items():
+        if callable(source):
+            row[field] = source(record)
+        else:
+            row[field] = record[source]
+            if field == 'value':
+                row[field] = to_cents(row[field])
+    return row
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_file(financier, path, mapping, account_name, file_format=None,
+                batch_size=500, checkpoint_file=None, progress=None,
+                idempotent=False, date_format=None, csv_options=None):
+    """
+    Import the transactions of a CSV or OFX file into the active budget of
+    ``financier`` (see :meth:`Financier.import_file`)
+
+    Returns
+    -------
+        Final ImportProgress
+    """
+    if file_format is None:
+        file_format = 'ofx' if path.lower().endswith(('.ofx', '.qfx')) \
+            else 'csv'
+    if file_format == 'ofx':
+        records = read_ofx(path)
+        mapping = dict(OFX_MAPPING, **(mapping or {}))
+    elif file_format == 'csv':
+        records = read_csv(path, **(csv_options or {}))
+    else:
+        raise ValueError('Unknown file format {0}'.format(file_format))
+    if date_format is not None:
+        source = mapping['date']
+        mapping = dict(mapping, date=lambda r: datetime.strptime(
+            source(r) if callable(source) else r[source],
+            date_format).strftime('%Y-%m-%d'))
+
+    # resume after the rows saved by a previous, interrupted run
+    file_id = {'path': os.path.abspath(path),
+               'size': os.path.getsize(path)}
+    done = 0
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('file') == file_id:
+            done = checkpoint['rows']
+            logger.info('resuming import of {0} after {1} rows'.format(
+                path, done))
+
+    def rows():
+        for i, record in enumerate(records):
+            if i < done:
+                continue
+            try:
+                row = map_record(record, mapping)
+            except (KeyError, ValueError, ArithmeticError) as e:
+                logger.warning('skipping record {0}: {1!r}'.format(i, e))
+                yield None
+                continue
+            row['account_name'] = account_name
+            yield row
+
+    start = time.monotonic()
+    count = done
+    saved = skipped = failed = batches = 0
+    status = ImportProgress(count, 0, 0, 0, 0, 0.0, 0.0)
+    for batch in _batches(rows(), batch_size):
+        results = financier.save_transactions(
+            [row for row in batch if row is not None],
+            batch_size=batch_size, idempotent=idempotent)
+        count += len(batch)
+        batches += 1
+        failed += len(batch) - len(results)
+        for r in results:
+            if r.get('ok'):
+                saved += 1
+            elif r.get('error') == 'conflict':
+                skipped += 1
+            else:
+                failed += 1
+        if checkpoint_file is not None:
+            tmp_path = checkpoint_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'file': file_id, 'rows': count}, f)
+            os.replace(tmp_path, checkpoint_file)
+        elapsed = time.monotonic() - start
+        status = ImportProgress(count, saved, skipped, failed, batches,
+                                elapsed,
+                                (count - done) / elapsed if elapsed else 0.0)
+        logger.info('imported {0} rows of {1} ({2:.0f} rows/s)'.format(
+            count, path, status.rows_per_second))
+        if progress is not None:
+            progress(status)
+
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return status
@@ -0,0 +1,223 @@
+"""
+Counters of the work done by python-financier: for each CouchDB operation
+the number of requests, their latency (as a histogram), the bytes sent and
+received, the retries and the HTTP status codes, and the hits and misses of
+the account, category and payee maps. A snapshot is returned by
+``stats()``, and can be exported in the Prometheus text format.
+"""
+
+from bisect import bisect_left
+import threading
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Histogram:
+    """
+    Distribution of observed values, counted in fixed buckets
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for the values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+            Dictionary with the cumulative ``buckets`` (list of
+            ``(upper bound, count)``, the last bound being ``inf``), the
+            ``sum`` and the ``count`` of the observed values
+        """
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),),
+                                self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics:
+    """
+    Thread-safe request and map counters, shared by an
+    :class:`~pythonfinancier.easycouchdb.EasyCouchdb` and the
+    :class:`~pythonfinancier.Financier` using it
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        """
+        Set every counter back to zero
+        """
+        with self.lock:
+            self.requests = {}
+            self.maps = {}
+
+    def _op(self, op):
+        counters = self.requests.get(op)
+        if counters is None:
+            counters = self.requests[op] = {
+                'count': 0, 'retries': 0, 'bytes_sent': 0,
+                'bytes_received': 0, 'status': {},
+                'latency': Histogram(self.buckets)}
+        return counters
+
+    def record_request(self, op, status_code, elapsed, bytes_sent,
+                       bytes_received):
+        """
+        Count a request (each attempt of a retried request counts)
+
+        Parameters
+        ----------
+        op : str
+            Name of the operation (e.g. 'query')
+        status_code : int
+            HTTP status of the response
+        elapsed : float
+            Time in seconds until the response was received
+        bytes_sent : int
+            Size of the request body
+        bytes_received : int
+            Size of the response body
+        """
+        with self.lock:
+            counters = self._op(op)
+            counters['count'] += 1
+            counters['bytes_sent'] += bytes_sent
+            counters['bytes_received'] += bytes_received
+            counters['status'][status_code] = \
+                counters['status'].get(status_code, 0) + 1
+            counters['latency'].observe(elapsed)
+
+    def record_retry(self, op):
+        """
+        Count a request of the operation ``op`` being sent again
+        """
+        with self.lock:
+            self._op(op)['retries'] += 1
+
+    def record_lookup(self, kind, hit):
+        """
+        Count a lookup in the ``kind`` ('account', 'category' or 'payee')
+        map, served from the map if ``hit`` or from the database otherwise
+        """
+        with self.lock:
+            counters = self.maps.setdefault(kind, {'hits': 0, 'misses': 0})
+            counters['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        """
+        Get a copy of all the counters
+
+        Returns
+        -------
+            Dictionary with the ``'requests'`` counters of each operation
+            (``count``, ``retries``, ``bytes_sent``, ``bytes_received``,
+            ``status`` counts and ``latency`` histogram, see
+            :meth:`Histogram.snapshot`) and the ``'maps'`` counters of each
+            map (``hits``, ``misses`` and ``hit_rate``)
+        """
+        with self.lock:
+            requests = {}
+            for op, counters in self.requests.items():
+                requests[op] = dict(counters, status=dict(counters['status']),
+                                    latency=counters['latency'].snapshot())
+            maps = {}
+            for kind, counters in self.maps.items():
+                lookups = counters['hits'] + counters['misses']
+                maps[kind] = dict(counters, hit_rate=counters['hits'] /
+                                  lookups if lookups else 0.0)
+        return {'requests': requests, 'maps': maps}
+
+    def prometheus(self, prefix='pythonfinancier'):
+        """
+        Export the counters in the Prometheus text format (e.g. to be
+        served on a ``/metrics`` endpoint)
+
+        Parameters
+        ----------
+        prefix : str
+            Prefix of the metric names
+
+        Returns
+        -------
+            The exposition text
+        """
+        return to_prometheus(self.snapshot(), prefix)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def to_prometheus(stats, prefix='pythonfinancier'):
+    """
+    Format a :meth:`Metrics.snapshot` in the Prometheus text format
+
+    Parameters
+    ----------
+    stats : dict
+        The snapshot
+    prefix : str
+        Prefix of the metric names
+
+    Returns
+    -------
+        The exposition text
+    """
+    lines = []
+
+    def family(name, kind, doc, samples):
+        name = '{0}_{1}'.format(prefix, name)
+        lines.append('# HELP {0} {1}'.format(name, doc))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        for suffix, labels, value in samples:
+            text = ','.join('{0}="{1}"'.format(k, v) for k, v in labels)
+            lines.append('{0}{1}{{{2}}} {3}'.format(name, suffix, text,
+                                                    _number(value)))
+
+    requests = sorted(stats['requests'].items())
+    family('requests_total', 'counter', 'CouchDB requests sent',
+           [('', [('op', op)], c['count']) for op, c in requests])
+    family('responses_total', 'counter', 'CouchDB responses by status',
+           [('', [('op', op), ('code', code)], n) for op, c in requests
+            for code, n in sorted(c['status'].items())])
+    family('retries_total', 'counter', 'CouchDB requests sent again',
+           [('', [('op', op)], c['retries']) for op, c in requests])
+    family('sent_bytes_total', 'counter', 'Request body bytes sent',
+           [('', [('op', op)], c['bytes_sent']) for op, c in requests])
+    family('received_bytes_total', 'counter', 'Response body bytes read',
+           [('', [('op', op)], c['bytes_received']) for op, c in requests])
+    samples = []
+    for op, c in requests:
+        latency = c['latency']
+        for bound, count in latency['buckets']:
+            samples.append(('_bucket', [('op', op), ('le', _number(bound))],
+                            count))
+        samples.append(('_sum', [('op', op)], latency['sum']))
+        samples.append(('_count', [('op', op)], latency['count']))
+    family('request_seconds', 'histogram', 'CouchDB request latency',
+           samples)
+    maps = sorted(stats['maps'].items())
+    family('map_hits_total', 'counter', 'Lookups served from a map',
+           [('', [('map', kind)], c['hits']) for kind, c in maps])
+    family('map_misses_total', 'counter', 'Lookups sent to the database',
+           [('', [('map', kind)], c['misses']) for kind, c in maps])
+    return '\n'.join(lines) + '\n'
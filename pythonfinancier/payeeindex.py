@@ -0,0 +1,173 @@
+"""
+In-memory index of the payees of a budget, for resolving the inconsistent
+payee names of bank exports ("CARREFOUR 123", "Carrefour #45") without a
+query per name. Names are normalized (case, accents, punctuation, numbers)
+before being compared, and can be looked up exactly, by prefix, or by
+trigram similarity.
+"""
+
+from bisect import bisect_left, insort
+import re
+import threading
+import unicodedata
+
+_PUNCTUATION = re.compile(r'[^\w\s]|_')
+_NUMBER = re.compile(r'\b\w*\d\w*\b')
+
+
+def normalize(name):
+    """
+    Normalize a payee name: lower case, without accents, punctuation,
+    words containing digits (store numbers, dates, references) or extra
+    whitespace
+
+    Parameters
+    ----------
+    name : str
+
+    Returns
+    -------
+        The normalized name (e.g. "carrefour" for "CARREFOUR #123")
+    """
+    text = unicodedata.normalize('NFKD', name)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = _PUNCTUATION.sub(' ', text.casefold())
+    words = _NUMBER.sub(' ', text).split()
+    if not words:
+        # nothing but numbers: keep them
+        words = text.split()
+    return ' '.join(words)
+
+
+def trigrams(key):
+    """
+    Set of the 3-character substrings of a normalized name (padded with
+    spaces, so short names and word boundaries count too)
+    """
+    padded = '  {0} '.format(key)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PayeeIndex:
+    """
+    Payees by normalized name, with prefix and trigram-similarity lookups.
+    When several payees have the same normalized name, the first one added
+    is kept.
+    """
+
+    def __init__(self, payees=()):
+        """
+        Create a PayeeIndex
+
+        Parameters
+        ----------
+        payees : iterable
+            Payee entries (dictionaries with at least ``name``) to add
+        """
+        self.lock = threading.RLock()
+        self.entries = {}
+        # normalized names, sorted (for prefix lookups)
+        self.keys = []
+        # trigram -> normalized names containing it
+        self.grams = {}
+        for payee in payees:
+            self.add(payee)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, payee):
+        """
+        Add a payee entry (dictionary with at least ``name``)
+        """
+        key = normalize(payee['name'])
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = payee
+            insort(self.keys, key)
+            for gram in trigrams(key):
+                self.grams.setdefault(gram, set()).add(key)
+
+    def get(self, name):
+        """
+        Get the payee whose normalized name is the same as ``name``'s, or
+        None
+        """
+        return self.entries.get(normalize(name))
+
+    def prefix(self, text, limit=10):
+        """
+        Get the payees whose normalized name starts with the normalized
+        ``text``, in alphabetical order
+
+        Parameters
+        ----------
+        text : str
+        limit : None or int
+            Maximum number of payees returned
+
+        Returns
+        -------
+            List of payee entries
+        """
+        start = normalize(text)
+        res = []
+        with self.lock:
+            for key in self.keys[bisect_left(self.keys, start):]:
+                if not key.startswith(start) or len(res) == limit:
+                    break
+                res.append(self.entries[key])
+        return res
+
+    def similar(self, name, threshold=0.5, limit=5):
+        """
+        Get the payees whose normalized name is the most similar to
+        ``name``'s, by the Dice coefficient of their trigrams
+
+        Parameters
+        ----------
+        name : str
+        threshold : float
+            Minimum similarity (between 0 and 1) of the returned payees
+        limit : None or int
+            Maximum number of payees returned
+
+        Returns
+        -------
+            List of ``(similarity, payee)``, most similar first
+        """
+        grams = trigrams(normalize(name))
+        shared = {}
+        with self.lock:
+            for gram in grams:
+                for key in self.grams.get(gram, ()):
+                    shared[key] = shared.get(key, 0) + 1
+            scored = [(2.0 * n / (len(grams) + len(trigrams(key))), key)
+                      for key, n in shared.items()]
+            scored.sort(key=lambda s: (-s[0], s[1]))
+            return [(score, self.entries[key]) for score, key in scored[:limit]
+                    if score >= threshold]
+
+    def match(self, name, threshold=0.7):
+        """
+        Get the payee a name most likely refers to: the one with the same
+        normalized name, or else the most similar one, if it is similar
+        enough
+
+        Parameters
+        ----------
+        name : str
+        threshold : float
+            Minimum similarity of a non-identical match
+
+        Returns
+        -------
+            The payee entry, or None
+        """
+        payee = self.get(name)
+        if payee is None:
+            best = self.similar(name, threshold, limit=1)
+            if best:
+                payee = best[0][1]
+        return payee
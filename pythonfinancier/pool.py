@@ -0,0 +1,161 @@
+"""
+Running jobs for many financier users at once. Each job gets its own
+Financier (its own login session and maps), connected to the job's budget,
+and runs in a pool of worker threads. The workers share one connection pool
+per host, a global request budget and a request budget per host, so the
+total time grows with the number of jobs per worker, not with the number
+of users.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from pythonfinancier.financier import Financier
+from pythonfinancier.metrics import Metrics
+from pythonfinancier.ratelimit import (AimdRateLimiter, LimiterGroup,
+                                       TokenBucket)
+
+PoolResult = namedtuple('PoolResult', ['username', 'budget', 'result',
+                                       'error', 'elapsed'])
+PoolResult.__doc__ = """
+Outcome of a job: user and budget, value returned by the job (or None),
+exception raised by the job or while connecting (or None) and duration in
+seconds
+"""
+
+
+class FinancierPool:
+    """
+    Runs ``(credentials, budget, job)`` entries on a pool of worker
+    threads, each job calling ``job(financier)`` with a Financier connected
+    to ``budget`` as that user
+    """
+
+    def __init__(self, url_couch_db, workers=8, rate=None, host_rate=10.0,
+                 financier_options=None):
+        """
+        Create a FinancierPool
+
+        Parameters
+        ----------
+        url_couch_db : str
+            Url of the Financier database, for the entries that do not give
+            their own
+        workers : int
+            Number of jobs running at the same time
+        rate : None or float
+            Maximum number of requests per second, all hosts together
+            (unlimited if None)
+        host_rate : float
+            Maximum number of requests per second to each host, lowered
+            while the server pushes back (see
+            :class:`~pythonfinancier.ratelimit.AimdRateLimiter`)
+        financier_options : None or dict
+            Other arguments of every :class:`~pythonfinancier.Financier`
+            (e.g. ``cache_dir`` or ``map_size``)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.url_couch_db = url_couch_db
+        self.workers = workers
+        self.host_rate = host_rate
+        self.financier_options = dict(financier_options or {})
+        self.limiter = TokenBucket(rate=rate, burst=max(1, workers))
+        # counters of every request of every job
+        self.metrics = Metrics()
+        self.lock = threading.Lock()
+        # connection pool and limiter of each host
+        self.adapters = {}
+        self.host_limiters = {}
+
+    def _host(self, url):
+        """
+        Get the shared adapter and limiter of the host of ``url``
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.adapters:
+                self.adapters[host] = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.workers)
+                self.host_limiters[host] = LimiterGroup(
+                    self.limiter, AimdRateLimiter(
+                        rate=self.host_rate, burst=max(1, self.workers),
+                        max_rate=self.host_rate))
+            return self.adapters[host], self.host_limiters[host]
+
+    def financier(self, credentials):
+        """
+        Create a Financier for a user, sharing the pool's connections,
+        limiters and metrics
+
+        Parameters
+        ----------
+        credentials : tuple or dict
+            ``(username, password)``, or a dictionary with ``username``,
+            ``password`` and optionally ``url_couch_db``
+
+        Returns
+        -------
+            The Financier instance (not connected to a budget yet)
+        """
+        if not isinstance(credentials, dict):
+            credentials = dict(zip(('username', 'password'), credentials))
+        url = credentials.get('url_couch_db') or self.url_couch_db
+        adapter, limiter = self._host(url)
+        options = dict(self.financier_options)
+        couchdb_options = dict(options.pop('couchdb_options', None) or {},
+                               adapter=adapter, metrics=self.metrics)
+        return Financier(url_couch_db=url,
+                         username=credentials['username'],
+                         password=credentials['password'],
+                         rate_limiter=limiter,
+                         couchdb_options=couchdb_options,
+                         **options)
+
+    def _run_one(self, entry):
+        credentials, budget, job = entry
+        username = credentials['username'] if isinstance(
+            credentials, dict) else credentials[0]
+        start = time.monotonic()
+        try:
+            f = self.financier(credentials)
+            f.connect_budget(budget)
+            result = job(f)
+        except Exception as e:
+            self.logger.warning('job of {0} on {1} failed: {2!r}'.format(
+                username, budget, e))
+            return PoolResult(username, budget, None, e,
+                              time.monotonic() - start)
+        return PoolResult(username, budget, result, None,
+                          time.monotonic() - start)
+
+    def run(self, entries):
+        """
+        Run the jobs. A failing job (e.g. wrong password or missing budget)
+        does not stop the others.
+
+        Parameters
+        ----------
+        entries : iterable
+            ``(credentials, budget, job)`` tuples: credentials as given to
+            :meth:`financier`, name of the budget, and a function called
+            with the connected Financier
+
+        Returns
+        -------
+            List of PoolResult, in the order of ``entries``
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self._run_one, entries))
+
+    def stats(self):
+        """
+        Get a snapshot of the metrics of every job (see
+        :meth:`pythonfinancier.metrics.Metrics.snapshot`)
+        """
+        return self.metrics.snapshot()
@@ -0,0 +1,200 @@
+"""
+Rate limiters used by EasyCouchdb to pace its requests. A limiter is asked
+for permission before every request (``acquire``) and told how the request
+went afterwards (``feedback``), so it can adapt to the server. All limiters
+are thread-safe, so one instance can be shared by every thread using an
+EasyCouchdb (or by several EasyCouchdb instances talking to the same host).
+"""
+
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import threading
+import time
+import logging
+
+
+def retry_after_seconds(value):
+    """
+    Parse the value of a ``Retry-After`` header
+
+    Parameters
+    ----------
+    value : str or None
+        Either a number of seconds or an HTTP date
+
+    Returns
+    -------
+        Number of seconds to wait (float), or None if ``value`` is empty or
+        cannot be parsed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """
+    Classic token bucket: requests are allowed at ``rate`` per second on
+    average, with bursts of up to ``burst`` requests.
+    """
+
+    def __init__(self, rate=2.0, burst=1):
+        """
+        Create a TokenBucket
+
+        Parameters
+        ----------
+        rate : float or None
+            Average number of requests allowed per second. If None, requests
+            are never delayed (except to honour a ``Retry-After``).
+        burst : int
+            Number of requests that can be made back to back before the
+            rate applies
+        """
+        self.logger = logging.getLogger(__name__)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(float(self.burst),
+                              self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """
+        Block until a request is allowed
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.rate is None:
+                    return
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def feedback(self, status_code, elapsed, retry_after=None):
+        """
+        Tell the limiter how a request went
+
+        Parameters
+        ----------
+        status_code : int
+            HTTP status of the response
+        elapsed : float
+            Duration of the request in seconds
+        retry_after : float or None
+            Seconds the server asked us to wait (``Retry-After`` header)
+        """
+        if retry_after:
+            with self.lock:
+                self.blocked_until = max(self.blocked_until,
+                                         time.monotonic() + retry_after)
+            self.logger.info('server asked to wait {0:.1f}s'.format(
+                retry_after))
+
+
+class AimdRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate adapts to the server (additive increase,
+    multiplicative decrease): the rate grows by ``increase`` after every
+    fast response, and is multiplied by ``decrease`` whenever the server
+    answers 429/503 or asks us to wait with ``Retry-After``.
+    """
+
+    BACKOFF_STATUS = (429, 503)
+
+    def __init__(self, rate=2.0, burst=1, min_rate=0.5, max_rate=50.0,
+                 increase=0.5, decrease=0.5, slow=1.0):
+        """
+        Create an AimdRateLimiter
+
+        Parameters
+        ----------
+        rate : float
+            Starting rate (requests per second)
+        burst : int
+            Number of requests that can be made back to back
+        min_rate : float
+            The rate never goes below this value
+        max_rate : float
+            The rate never goes above this value
+        increase : float
+            Added to the rate after each fast, successful response
+        decrease : float
+            Factor applied to the rate when the server pushes back
+        slow : float
+            Responses taking longer than this (in seconds) do not increase
+            the rate
+        """
+        super().__init__(rate=rate, burst=burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.slow = slow
+
+    def feedback(self, status_code, elapsed, retry_after=None):
+        super().feedback(status_code, elapsed, retry_after)
+        with self.lock:
+            self._refill(time.monotonic())
+            if status_code in self.BACKOFF_STATUS or retry_after:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.logger.info('backing off to {0:.2f} '
+                                 'requests/s'.format(self.rate))
+            elif status_code < 400 and elapsed < self.slow:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class LimiterGroup:
+    """
+    Several limiters applied together (e.g. a global request budget shared
+    by every host, and one limiter per host): a request waits for all of
+    them, and all of them get its feedback
+    """
+
+    def __init__(self, *limiters):
+        """
+        Create a LimiterGroup
+
+        Parameters
+        ----------
+        limiters
+            The limiters (TokenBucket or AimdRateLimiter instances)
+        """
+        self.limiters = limiters
+
+    def acquire(self):
+        """
+        Block until a request is allowed by every limiter
+        """
+        for limiter in self.limiters:
+            limiter.acquire()
+
+    def feedback(self, status_code, elapsed, retry_after=None):
+        """
+        Tell every limiter how a request went
+        """
+        for limiter in self.limiters:
+            limiter.feedback(status_code, elapsed, retry_after)
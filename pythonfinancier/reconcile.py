@@ -0,0 +1,71 @@
+"""
+Matching of bank statement rows against the transactions already in a
+budget, to find which rows still need to be imported. Transactions are
+grouped by value and sorted by date, so each row is matched with a binary
+search instead of a query (or a scan) per row.
+"""
+
+from bisect import bisect_left, bisect_right
+from datetime import date as Date
+
+
+def day_number(value):
+    """
+    Convert a YYYY-MM-DD date into a day number
+    """
+    return Date.fromisoformat(value[:10]).toordinal()
+
+
+def match_rows(rows, docs, date_tolerance_days=3):
+    """
+    Match statement rows with existing transactions, on an equal value and
+    a date within ``date_tolerance_days``. Each transaction is matched at
+    most once; rows are handled in date order.
+
+    Parameters
+    ----------
+    rows : list
+        Statement rows: dictionaries with (at least) ``value`` (in cents)
+        and ``date`` (YYYY-MM-DD)
+    docs : iterable
+        Existing transaction json objects (with ``_id``, ``value`` and
+        ``date``)
+    date_tolerance_days : int
+        Maximum difference in days between a row and its transaction
+
+    Returns
+    -------
+        Dictionary with the ``'matched'`` rows (list of ``(row, doc)``),
+        the ``'missing'`` rows (list of rows with no candidate transaction)
+        and the ``'ambiguous'`` rows (list of ``(row, docs)``, for rows
+        whose closest candidates are equally close)
+    """
+    by_value = {}
+    for doc in docs:
+        by_value.setdefault(doc['value'], []).append(
+            (day_number(doc['date']), doc['_id'], doc))
+    days = {}
+    for value, entries in by_value.items():
+        entries.sort(key=lambda e: (e[0], e[1]))
+        days[value] = [e[0] for e in entries]
+
+    claimed = set()
+    result = {'matched': [], 'missing': [], 'ambiguous': []}
+    for row in sorted(rows, key=lambda r: r['date']):
+        day = day_number(row['date'])
+        entries = by_value.get(row['value'], [])
+        entry_days = days.get(row['value'], [])
+        lo = bisect_left(entry_days, day - date_tolerance_days)
+        hi = bisect_right(entry_days, day + date_tolerance_days)
+        candidates = [e for e in entries[lo:hi] if e[1] not in claimed]
+        if not candidates:
+            result['missing'].append(row)
+            continue
+        best = min(abs(e[0] - day) for e in candidates)
+        closest = [e for e in candidates if abs(e[0] - day) == best]
+        if len(closest) == 1:
+            claimed.add(closest[0][1])
+            result['matched'].append((row, closest[0][2]))
+        else:
+            result['ambiguous'].append((row, [e[2] for e in closest]))
+    return result
@@ -0,0 +1,290 @@
+"""
+A local, read-only copy of a Financier budget in an SQLite file, kept up
+to date from the CouchDB changes feed. Lookups that would each cost a
+round trip to the server (finding accounts, categories, payees or
+transactions) are answered from indexed local tables instead.
+"""
+
+import json
+import logging
+import sqlite3
+
+from pythonfinancier.financier import split_id
+
+
+class LocalReplica:
+    """
+    SQLite replica of the active budget of a Financier instance, offering
+    the same ``find_*`` methods as :class:`~pythonfinancier.Financier`
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT);
+        CREATE TABLE IF NOT EXISTS docs (
+            id TEXT PRIMARY KEY,
+            kind TEXT,
+            name TEXT,
+            doc TEXT);
+        CREATE TABLE IF NOT EXISTS transactions (
+            id TEXT PRIMARY KEY,
+            date TEXT,
+            value INTEGER,
+            account TEXT,
+            payee TEXT,
+            category TEXT,
+            memo TEXT,
+            doc TEXT);
+        CREATE INDEX IF NOT EXISTS docs_kind_name ON docs (kind, name);
+        CREATE INDEX IF NOT EXISTS transactions_date
+            ON transactions (date);
+        CREATE INDEX IF NOT EXISTS transactions_account
+            ON transactions (account, date);
+        CREATE INDEX IF NOT EXISTS transactions_payee
+            ON transactions (payee, date);
+        CREATE INDEX IF NOT EXISTS transactions_category
+            ON transactions (category, date);
+        CREATE INDEX IF NOT EXISTS transactions_value
+            ON transactions (value);
+    '''
+
+    def __init__(self, financier, path):
+        """
+        Create (or open) the replica of the active budget of ``financier``
+
+        Parameters
+        ----------
+        financier : Financier
+            Instance connected to the budget to replicate
+        path : str
+            Location of the SQLite file (``':memory:'`` for a replica that
+            is not kept on disk)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.financier = financier
+        self.budget_selector = financier.budget_selector
+        self.prefix = self.budget_selector + '_'
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(self.SCHEMA)
+        budget = self._meta('budget')
+        if budget is None:
+            with self.conn:
+                self._set_meta('budget', self.budget_selector)
+        elif budget != self.budget_selector:
+            raise ValueError('{0} is a replica of budget {1}'.format(
+                path, budget))
+
+    def _meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                (key,)).fetchone()
+        return row['value'] if row else None
+
+    def _set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                          (key, value))
+
+    @property
+    def checkpoint(self):
+        """
+        Sequence of the changes feed the replica is up to date with
+        """
+        return self._meta('seq') or 0
+
+    def sync(self, batch_size=1000):
+        """
+        Pull the changes made to the budget since the last checkpoint. Each
+        batch is stored along with its checkpoint in a single SQLite
+        transaction, so an interrupted sync resumes where it stopped.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of changes read per request
+
+        Returns
+        -------
+            Number of changes of the budget applied to the replica
+        """
+        cdb = self.financier.cdb
+        applied = 0
+        while True:
+            res = cdb.changes(self.financier.user_db, since=self.checkpoint,
+                              limit=batch_size, include_docs=True).json()
+            with self.conn:
+                for row in res['results']:
+                    if row['id'].startswith(self.prefix):
+                        self._apply(row)
+                        applied += 1
+                self._set_meta('seq', str(res['last_seq']))
+            self.logger.debug('replica at seq {0}'.format(res['last_seq']))
+            if len(res['results']) < batch_size:
+                break
+        return applied
+
+    def _apply(self, row):
+        doc_id = row['id']
+        self.conn.execute('DELETE FROM docs WHERE id = ?', (doc_id,))
+        self.conn.execute('DELETE FROM transactions WHERE id = ?', (doc_id,))
+        doc = row.get('doc')
+        if row.get('deleted') or not doc or doc.get('_deleted'):
+            return
+        kind = doc_id[len(self.prefix):].rsplit('_', 1)[0]
+        if kind == 'transaction':
+            self.conn.execute(
+                'INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (doc_id, doc.get('date'), doc.get('value'),
+                 doc.get('account'), doc.get('payee'), doc.get('category'),
+                 doc.get('memo'), json.dumps(doc)))
+        else:
+            self.conn.execute('INSERT INTO docs VALUES (?, ?, ?, ?)',
+                              (doc_id, kind, doc.get('name'),
+                               json.dumps(doc)))
+
+    def _find_named(self, kind, name):
+        return [json.loads(r['doc']) for r in self.conn.execute(
+            'SELECT doc FROM docs WHERE kind = ? AND name = ? ORDER BY id',
+            (kind, name))]
+
+    def get_all_accounts(self):
+        """
+        Get a list of all accounts present within the budget
+
+        Returns
+        -------
+            List of accounts (``_id`` and ``name``)
+        """
+        return [{'_id': r['id'], 'name': r['name']}
+                for r in self.conn.execute(
+                    "SELECT id, name FROM docs WHERE kind = 'account' "
+                    "ORDER BY id")]
+
+    def find_account(self, name):
+        """
+        Find an account by name. Raises a ValueError if the account is not
+        found.
+
+        Parameters
+        ----------
+        name : str
+            Name for which to search (must be an exact match)
+        Returns
+        -------
+            Doc dictionary of the account with bare ``_id`` and ``name``
+        """
+        res = self._find_named('account', name)
+        if not res:
+            raise ValueError("Account not found")
+        return {'_id': split_id(res[0]['_id']), 'name': res[0]['name']}
+
+    def find_category(self, name):
+        """
+        Find a category by name. Raises a ValueError if the category is not
+        found.
+
+        Parameters
+        ----------
+        name : str
+            Name for which to search (must be an exact match)
+        Returns
+        -------
+            Doc dictionary of the category with bare ``_id`` and ``name``
+        """
+        if name in ['income', 'incomeNextMonth']:
+            return {'_id': name, 'name': name}
+        res = self._find_named('category', name)
+        if not res:
+            raise ValueError("Category not found")
+        return {'_id': split_id(res[0]['_id']), 'name': res[0]['name']}
+
+    def find_payee(self, name):
+        """
+        Find payee(s) by name
+
+        Parameters
+        ----------
+        name : str
+            Name for which to search (must be an exact match)
+        Returns
+        -------
+            List of payee json objects that match the given name
+        """
+        return [{'_id': d['_id'], 'name': d['name'],
+                 'categorySuggest': d.get('categorySuggest')}
+                for d in self._find_named('payee', name)]
+
+    def get_transaction(self, id_transaction):
+        """
+        Get the JSON object representing a transaction
+
+        Parameters
+        ----------
+        id_transaction : str
+            Full transaction id
+
+        Returns
+        -------
+            The transaction document, or None if it does not exist
+        """
+        row = self.conn.execute('SELECT doc FROM transactions WHERE id = ?',
+                                (id_transaction,)).fetchone()
+        return json.loads(row['doc']) if row else None
+
+    def find_transaction(self,
+                         memo=None,
+                         value=None,
+                         date=None,
+                         date_from=None,
+                         date_to=None,
+                         value_min=None,
+                         value_max=None,
+                         account_name=None,
+                         payee_name=None,
+                         category_name=None):
+        """
+        Find transaction(s) in the budget (see
+        :meth:`Financier.transaction_selector` for the filters)
+
+        Returns
+        -------
+            List of transaction json objects that match, ordered by date
+        """
+        clauses = []
+        args = []
+        for clause, arg in (('memo = ?', memo),
+                            ('value = ?', value),
+                            ('date = ?', date),
+                            ('date >= ?', date_from),
+                            ('date <= ?', date_to),
+                            ('value >= ?', value_min),
+                            ('value <= ?', value_max)):
+            if arg is not None:
+                clauses.append(clause)
+                args.append(arg)
+        if account_name is not None:
+            clauses.append('account = ?')
+            args.append(self.find_account(account_name)['_id'])
+        if payee_name is not None:
+            payee = self.find_payee(payee_name)
+            if not payee:
+                return []
+            clauses.append('payee = ?')
+            args.append(split_id(payee[0]['_id']))
+        if category_name is not None:
+            category_id = self.find_category(category_name)['_id']
+            clauses.append(
+                "(category = ? OR EXISTS (SELECT 1 FROM json_each(doc, "
+                "'$.splits') WHERE json_extract(value, '$.category') = ?))")
+            args.extend([category_id, category_id])
+        sql = 'SELECT doc FROM transactions'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY date, id'
+        return [json.loads(r['doc']) for r in self.conn.execute(sql, args)]
+
+    def close(self):
+        """
+        Close the SQLite connection
+        """
+        self.conn.close()
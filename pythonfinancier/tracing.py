@@ -0,0 +1,95 @@
+"""
+Tracing of the round trips made by a block of code. A :class:`Trace`
+records every HTTP request sent (with its operation, selector, duration and
+sizes) and every account, category or payee lookup (served from a map or
+not), in order:
+
+    with f.trace() as t:
+        f.save_split(...)
+    print(t.summary())
+"""
+
+from collections import namedtuple
+import threading
+
+Call = namedtuple('Call', ['op', 'method', 'url', 'selector', 'duration',
+                           'bytes_sent', 'bytes_received', 'status_code'])
+Call.__doc__ = """
+An HTTP request: operation (e.g. 'query'), method, url, Mango selector (for
+``_find`` requests), duration in seconds, body sizes and response status
+"""
+
+Lookup = namedtuple('Lookup', ['kind', 'name', 'from_map'])
+Lookup.__doc__ = """
+A lookup of the ``name`` of an account, category or payee (``kind``), and
+whether it was served from the map (instead of the database)
+"""
+
+
+class Trace:
+    """
+    Events recorded while a trace is active. Requests sent by other threads
+    using the same instance during that time are recorded too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def after_request(self, op, method, url, kwargs, response, elapsed):
+        """
+        ``after_request`` hook of
+        :class:`~pythonfinancier.easycouchdb.EasyCouchdb` recording the
+        request
+        """
+        body = kwargs.get('json')
+        selector = body.get('selector') if isinstance(body, dict) else None
+        call = Call(op, method.upper(), url, selector, elapsed,
+                    len(response.request.body or b''), len(response.content),
+                    response.status_code)
+        with self.lock:
+            self.events.append(call)
+
+    def lookup(self, kind, name, from_map):
+        """
+        Record a lookup in the ``kind`` map
+        """
+        with self.lock:
+            self.events.append(Lookup(kind, name, from_map))
+
+    @property
+    def calls(self):
+        """
+        List of the recorded requests (Call)
+        """
+        return [e for e in self.events if isinstance(e, Call)]
+
+    @property
+    def lookups(self):
+        """
+        List of the recorded lookups (Lookup)
+        """
+        return [e for e in self.events if isinstance(e, Lookup)]
+
+    def summary(self):
+        """
+        Totals of the trace
+
+        Returns
+        -------
+            Dictionary with the number of ``requests`` per operation, their
+            total ``duration`` and ``bytes_sent``, and the number of
+            lookups served from the maps (``map_hits``) or not
+            (``map_misses``)
+        """
+        calls = self.calls
+        lookups = self.lookups
+        requests = {}
+        for call in calls:
+            requests[call.op] = requests.get(call.op, 0) + 1
+        hits = sum(1 for lookup in lookups if lookup.from_map)
+        return {'requests': requests,
+                'duration': sum(call.duration for call in calls),
+                'bytes_sent': sum(call.bytes_sent for call in calls),
+                'map_hits': hits,
+                'map_misses': len(lookups) - hits}
@@ -0,0 +1,60 @@
+"""
+CouchDB map/reduce views summing the transactions of every budget on the
+server side, so reports read a few rows instead of every transaction:
+``account_month`` is keyed by ``[budget, account, month]`` and
+``category_month`` by ``[budget, category, month]`` (split transactions
+count towards the category of each split). Both are reduced with
+``_sum``, so querying them with ``group_level`` gives totals per budget,
+per account (or category) or per month.
+"""
+
+# name of the design document holding the views
+DDOC = 'python-financier-views'
+
+ACCOUNT_MONTH = '''function (doc) {
+  var m = doc._id.match(/^(b_[^_]+)_transaction_/);
+  if (m && typeof doc.value === 'number' && doc.account) {
+    emit([m[1], doc.account, (doc.date || '').substring(0, 7)], doc.value);
+  }
+}'''
+
+CATEGORY_MONTH = '''function (doc) {
+  var m = doc._id.match(/^(b_[^_]+)_transaction_/);
+  if (!m || typeof doc.value !== 'number') {
+    return;
+  }
+  var month = (doc.date || '').substring(0, 7);
+  if (doc.splits && doc.splits.length) {
+    for (var i = 0; i < doc.splits.length; i++) {
+      var split = doc.splits[i];
+      if (split.category && typeof split.value === 'number') {
+        emit([m[1], split.category, month], split.value);
+      }
+    }
+  } else if (doc.category) {
+    emit([m[1], doc.category, month], doc.value);
+  }
+}'''
+
+
+def design_doc():
+    """
+    Build the design document of the views
+
+    Returns
+    -------
+        The design document (without ``_rev``)
+    """
+    return {'_id': '_design/' + DDOC,
+            'language': 'javascript',
+            'views': {'account_month': {'map': ACCOUNT_MONTH,
+                                        'reduce': '_sum'},
+                      'category_month': {'map': CATEGORY_MONTH,
+                                         'reduce': '_sum'}}}
+
+
+def key_range(budget_selector):
+    """
+    Query parameters restricting a view to the rows of one budget
+    """
+    return {'startkey': [budget_selector], 'endkey': [budget_selector, {}]}
@@ -0,0 +1,152 @@
+"""
+Write-behind buffering of new documents. Instead of one PUT per document,
+documents are queued and written with ``_bulk_docs`` once enough of them
+are waiting, or once the oldest has waited long enough. Each queued
+document gets a :class:`concurrent.futures.Future` of its result.
+"""
+
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+
+class BufferedWriter:
+    """
+    Queue of new documents written in batches, from the thread queueing the
+    document that fills a batch, or from a background thread when the
+    oldest document has waited ``max_delay`` seconds
+    """
+
+    def __init__(self, cdb, db_name, max_docs=500, max_delay=0.5):
+        """
+        Create a BufferedWriter
+
+        Parameters
+        ----------
+        cdb : EasyCouchdb
+            Connection used to write the documents
+        db_name : str
+            Name of the database into which to write
+        max_docs : int
+            Number of queued documents that triggers a write
+        max_delay : float
+            Maximum number of seconds a document waits before being written
+        """
+        self.logger = logging.getLogger(__name__)
+        self.cdb = cdb
+        self.db_name = db_name
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # held while a batch is taken and written, so flush() returns only
+        # after every document queued before it has been written
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        # time at which the oldest queued document was queued
+        self.oldest = None
+        self.closed = False
+        self.thread = None
+
+    def submit(self, doc):
+        """
+        Queue a new document
+
+        Parameters
+        ----------
+        doc : dict
+            The document (with its ``_id``)
+
+        Returns
+        -------
+            Future of the result of the write: the ``_bulk_docs`` result of
+            the document (``ok``, ``id`` and ``rev``), or None if a document
+            with the same id already existed. Other errors are raised by
+            the future (as IOError).
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ValueError('BufferedWriter is closed')
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            if not self.buffer:
+                self.oldest = time.monotonic()
+                self.condition.notify()
+            self.buffer.append((doc, future))
+            full = len(self.buffer) >= self.max_docs
+        if full:
+            # written by the caller, which slows down producers that are
+            # faster than the database
+            self.flush()
+        return future
+
+    def flush(self):
+        """
+        Write the queued documents now, returning once they are written
+        """
+        with self.write_lock:
+            with self.lock:
+                batch = self.buffer
+                self.buffer = []
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        try:
+            res = self.cdb.bulk_docs(self.db_name, [doc for doc, _ in batch])
+            if res.status_code >= 400:
+                raise IOError('_bulk_docs answered {0}: {1}'.format(
+                    res.status_code, res.text[:200]))
+            results = res.json()
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.logger.debug('wrote {0} buffered documents'.format(len(batch)))
+        for (doc, future), result in zip(batch, results):
+            if result.get('ok'):
+                future.set_result(result)
+            elif result.get('error') == 'conflict':
+                self.logger.warning(
+                    'transaction {0} has already been imported '.format(
+                        doc['_id']))
+                future.set_result(None)
+            else:
+                future.set_exception(IOError('{0}: {1} ({2})'.format(
+                    doc['_id'], result.get('error'), result.get('reason'))))
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.buffer and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                wait = self.oldest + self.max_delay - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+            self.flush()
+
+    def close(self):
+        """
+        Write the queued documents and stop the background thread; no
+        document can be queued afterwards
+        """
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        # documents queued while closing
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()